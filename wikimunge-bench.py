@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from wikimunge                import WikiMunge
+from wikimunge.common         import MAGIC_FIRST, MAGIC_LAST
+from wikimunge.common         import MAGIC_NOWIKI_CHAR
+from wikimunge.encoder        import CookieTable, encode, encode_passes
+from wikimunge.encoder        import encode_scan
+from wikimunge.expander       import preprocess_text
+from wikimunge.profiler       import Profiler
+from wikimunge.memo           import TemplateMemo
+from wikimunge.mediawikisax   import MediaWikiSAX
+from wikimunge.mediawikiexpat import MediaWikiExpat
+
+
+def report(name, count, delta):
+  print('  {:<24} {:>10,} pages {:>8.2f} sec {:>12,} pages/sec'.format(
+    name, count, delta, int(count / delta) if delta else 0))
+
+
+def bench_reader(args):
+  print('Dump reader: %s' % args.filename)
+
+  for reader in (MediaWikiSAX, MediaWikiExpat):
+    count = 0
+
+    def handler(model, ns, title, text):
+      nonlocal count
+      count += 1
+
+    start = time.time()
+    reader().parse(args.filename, handler)
+    report(reader.__name__, count, time.time() - start)
+
+
+def bench_cache(args):
+  print('Page cache: %s' % args.filename)
+
+  pages = list(MediaWikiExpat().read(args.filename))
+  backends = (('file', None), ('file', 'zlib'), ('file', 'lzma'),
+              ('sqlite', None))
+
+  for backend, compress in backends:
+    name   = backend + ('-' + compress if compress else '')
+    outdir = tempfile.mkdtemp(prefix = 'wikimunge-bench-')
+
+    try:
+      munge = WikiMunge(args.lang, outdir, compress = compress,
+                        backend = backend)
+
+      start = time.time()
+      for model, ns, title, text in pages:
+        munge.cache.add(model, title, ''.join(text))
+      munge.cache.save()
+      report(name + ' ingest', len(pages), time.time() - start)
+
+      titles = list(munge.cache.pages)
+      titles = [random.choice(titles) for i in range(args.reads)]
+
+      start = time.time()
+      for title in titles: munge.cache.read(title)
+      report(name + ' read', len(titles), time.time() - start)
+
+      titles = list(munge.cache.templates)
+      titles = [random.choice(titles) for i in range(args.reads)]
+
+      start = time.time()
+      for title in titles: munge.ctx.get_template(title)
+      report(name + ' template read', len(titles), time.time() - start)
+
+      munge.cache.close()
+
+    finally: shutil.rmtree(outdir)
+
+
+class DecodingTable(CookieTable):
+  '''A cookie table whose encodings can be compared.'''
+
+  def decode(self, text):
+    '''Replaces cookies by their contents so that encodings can be compared
+    regardless of the order in which cookies were saved.'''
+    def repl(m):
+      kind, args, nowiki = self.cookies[ord(m.group(0)) - MAGIC_FIRST]
+      return '\0%s%s(%s)\0' % (kind, '!' if nowiki else '',
+                               '|'.join(self.decode(arg) for arg in args))
+
+    return re.sub('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST), repl, text)
+
+
+def encode_regex(ctx, text):
+  '''Encodes with regular expressions only.'''
+  return encode_passes(ctx, text)[0]
+
+
+ENCODERS = (('encode_regex', encode_regex), ('encode_scan', encode_scan),
+            ('encode', encode))
+
+
+def time_encoder(encoder, text):
+  start = time.time()
+  encoder(CookieTable(), text)
+  return time.time() - start
+
+
+def bench_encoder(args):
+  print('Encoder: %s' % args.filename)
+
+  texts = []
+  for model, ns, title, text in MediaWikiExpat().read(args.filename):
+    if model != 'wikitext': continue
+    text = preprocess_text(CookieTable(), ''.join(text))
+    texts.append((title, text))
+
+  # Differential test of the encoders
+  mismatches = [0] * len(ENCODERS)
+  times      = [0] * len(ENCODERS)
+
+  for title, text in texts:
+    results = []
+
+    for i, (name, encoder) in enumerate(ENCODERS):
+      table  = DecodingTable()
+      start  = time.time()
+      result = encoder(table, text)
+      times[i] += time.time() - start
+
+      results.append((table.decode(result),
+                      sorted(table.decode(msg) for msg in table.messages)))
+
+    for i, (name, encoder) in enumerate(ENCODERS[1:], 1):
+      if results[i] != results[0]:
+        if mismatches[i] < 10: print('  %s mismatch: %s' % (name, title))
+        mismatches[i] += 1
+
+  for i, (name, encoder) in enumerate(ENCODERS):
+    report(name, len(texts), times[i])
+    if i: print('  {:<24} {:>10,} mismatches'.format('', mismatches[i]))
+
+  # Largest pages and deeply nested templates
+  texts.sort(key = lambda t: len(t[1]), reverse = True)
+  large  = [('all pages', '\n'.join(text for title, text in texts))]
+  nested = [('nested %d' % depth, '{{a|' * depth + 'b' + '}}' * depth)
+            for depth in (100, 1000)]
+
+  print('  {:<30} {:>12}'.format('page', 'chars') +
+        ''.join(' {:>12}'.format(name) for name, encoder in ENCODERS))
+  for title, text in texts[:args.top] + large + nested:
+    print('  {:<30} {:>12,}'.format(title[:30], len(text)) +
+          ''.join(' {:>10.3f} s'.format(time_encoder(encoder, text))
+                  for name, encoder in ENCODERS))
+
+
+def bench_expand(args):
+  print('Expander: %s' % args.filename)
+
+  outdir = tempfile.mkdtemp(prefix = 'wikimunge-bench-')
+
+  try:
+    munge = WikiMunge(args.lang, outdir)
+    pages = []
+
+    for model, ns, title, text in MediaWikiExpat().read(args.filename):
+      text = ''.join(text)
+      munge.add_page(model, title, text)
+      if model == 'wikitext' and not ns: pages.append((title, text))
+
+    munge.cache.redirect_templates()
+    munge.cache.save()
+
+    # Join each nested expansion or expand into one output list
+    outputs = []
+    times   = []
+
+    for rope in (False, True):
+      munge.ctx.rope = rope
+      outputs.append([])
+      times.append([])
+
+      for title, text in pages:
+        start  = time.time()
+        output = munge.expand(title, text)
+        times[-1].append((title, len(output), time.time() - start))
+        outputs[-1].append(output)
+
+    mismatches = sum(a != b for a, b in zip(*outputs))
+    print('  {:,} pages {:,} mismatches'.format(len(pages), mismatches))
+    report('join', len(pages), sum(t[2] for t in times[0]))
+    report('rope', len(pages), sum(t[2] for t in times[1]))
+
+    # Pages with the largest output, e.g. inflection tables
+    order = sorted(range(len(pages)), key = lambda i: times[0][i][1],
+                   reverse = True)
+
+    print('  {:<30} {:>12} {:>12} {:>12}'.format(
+      'page', 'output', 'join', 'rope'))
+    for i in order[:args.top]:
+      title, size, join = times[0][i]
+      print('  {:<30} {:>12,} {:>10.3f} s {:>10.3f} s'.format(
+        title[:30], size, join, times[1][i][2]))
+
+    munge.cache.close()
+
+  finally: shutil.rmtree(outdir)
+
+
+def check_deep_parserfn(munge):
+  '''Nested parser function calls expand on the work stack.'''
+  depth = 30 # Within the limit of 100 nested calls
+
+  for call in ('#if:x|', '#ifeq:a|a|', '#switch:a|b=c|a='):
+    text = 'z'
+    for i in range(depth): text = '{{%s{{echo|%s}}}}' % (call, text)
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try: output = munge.expand('Check', text)
+    except RecursionError: output = 'RecursionError'
+    finally: sys.setrecursionlimit(limit)
+
+    if output != 'z': return '%s nested %d deep gave %r' % (
+      call, depth, output[:60])
+
+
+def check_profile_names(munge):
+  '''Spellings of a template name share one profile entry.'''
+  munge.ctx.profiler = Profiler()
+  try: munge.expand('Check', '{{foo bar}}{{foo_bar}}{{ foo  bar }}')
+  finally: profiler, munge.ctx.profiler = munge.ctx.profiler, None
+
+  calls = {name: stats[0] for name, stats in profiler.stats.items()}
+  if calls != {'foo bar': 3}: return 'profiled %r' % calls
+
+
+def check_memo_names(munge):
+  '''Spellings of a template name share one memo entry.'''
+  munge.ctx.template_memo = TemplateMemo(munge.ctx, 10000)
+  try: munge.expand('Check', '{{foo bar}}{{foo_bar}}{{ foo  bar }}')
+  finally: memo, munge.ctx.template_memo = munge.ctx.template_memo, None
+
+  if (memo.misses, memo.hits) != (1, 2):
+    return '%d misses and %d hits' % (memo.misses, memo.hits)
+
+
+# Templates that start with a table, which may go on past the braces that
+# end it.  N is a <nowiki />.
+SCAN_CASES = (
+  '{{{||}}x}}', '{{{||}}|}}', '{{{{||}}|}}', '{{{|x|}}|}}', '{{{||}}{x}}',
+  '{{{||}}{{{}}}}}', '{{{||}}{{a}}}}', '{{{|{{a}}|}}{{a}}}}', '{{>{N{||}}}',
+  '{{|{N{||}|}}', '{{{{{}}}{N{||}{||}}N}', '{{{||}}[={N{||}}}',
+)
+
+
+def check_scan_tables(munge):
+  '''encode_scan() encodes templates that start with a table as
+  encode_passes() does.'''
+  for case in SCAN_CASES:
+    text    = case.replace('N', MAGIC_NOWIKI_CHAR)
+    results = []
+
+    for encoder in (encode_regex, encode_scan):
+      table = DecodingTable()
+      results.append((table.decode(encoder(table, text)), table.messages))
+
+    if results[0] != results[1]: return 'mismatch: %r' % case
+
+
+CHECKS = (check_deep_parserfn, check_profile_names, check_memo_names,
+          check_scan_tables)
+
+
+def bench_check(args):
+  print('Checks:')
+
+  outdir = tempfile.mkdtemp(prefix = 'wikimunge-bench-')
+  failed = 0
+
+  try:
+    munge = WikiMunge('en', outdir)
+    munge.add_page('wikitext', 'Template:echo', '{{{1}}}')
+    munge.add_page('wikitext', 'Template:foo bar', 'foo')
+    munge.cache.save()
+
+    for check in CHECKS:
+      error = check(munge)
+      print('  {:<30} {}'.format(check.__name__[6:], error or 'ok'))
+      if error: failed += 1
+
+    munge.cache.close()
+
+  finally: shutil.rmtree(outdir)
+
+  if failed: sys.exit(1)
+
+
+parser = argparse.ArgumentParser(
+  prog = 'wikimunge-bench',
+  description = 'Benchmark wikimunge components.')
+commands = parser.add_subparsers(dest = 'command', required = True)
+
+cmd = commands.add_parser('reader', help = 'Compare dump readers.')
+cmd.add_argument('filename', help = 'MediaWiki XML dump file')
+cmd.set_defaults(run = bench_reader)
+
+cmd = commands.add_parser(
+  'cache', help = 'Compare page cache ingest and random read throughput.')
+cmd.add_argument('filename', help = 'MediaWiki XML dump file')
+cmd.add_argument('-l', '--lang', default = 'en', help = 'Dump language')
+cmd.add_argument('-n', '--reads', type = int, default = 100000,
+                 help = 'Number of random page reads')
+cmd.set_defaults(run = bench_cache)
+
+cmd = commands.add_parser(
+  'encoder', help = 'Compare the regex, scanning and combined encoders.')
+cmd.add_argument('filename', help = 'MediaWiki XML dump file')
+cmd.add_argument('-t', '--top', type = int, default = 5,
+                 help = 'Number of largest pages to time')
+cmd.set_defaults(run = bench_encoder)
+
+cmd = commands.add_parser(
+  'expand', help = 'Compare joined and rope expansion output.')
+cmd.add_argument('filename', help = 'MediaWiki XML dump file')
+cmd.add_argument('-l', '--lang', default = 'en', help = 'Dump language')
+cmd.add_argument('-t', '--top', type = int, default = 5,
+                 help = 'Number of largest pages to time')
+cmd.set_defaults(run = bench_expand)
+
+cmd = commands.add_parser(
+  'check', help = 'Run regression checks of the expander and encoder.')
+cmd.set_defaults(run = bench_check)
+
+args = parser.parse_args()
+args.run(args)
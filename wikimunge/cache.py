@@ -1,6 +1,26 @@
 import os
 import re
+import lzma
+import mmap
+import zlib
+import array
 import pickle
+import shutil
+import collections
+
+from .pageindex import MappedTable, OverlayDict, open_index, write_index, \
+  map_array
+
+
+# Compressors for the block compressed cache format
+COMPRESSORS = {
+  'zlib': (zlib.compress, zlib.decompress),
+  'lzma': (lzma.compress, lzma.decompress),
+}
+
+BLOCK_SIZE       = 1 << 20
+SMALL_BLOCK_SIZE = 1 << 16 # Templates and modules, which are read often
+BLOCK_CACHE      = 8       # Number of decompressed blocks kept in memory
 
 
 def __get_template_body(text):
@@ -109,36 +129,223 @@ def _get_template_body(text):
   return re.sub(r'(?is)<\s*(/\s*)?includeonly\s*(/\s*)?>', '', text)
 
 
+def _encode_revision(info):
+  return '\t'.join('' if v is None else str(v) for v in info)
+
+
+def _decode_revision(text):
+  id, revid, timestamp, sha1 = text.split('\t')
+  return (int(id) if id else None, int(revid) if revid else None,
+          timestamp or None, sha1 or None)
+
+
 class PageCache:
-  def __init__(self, name_data, path):
+  '''Page texts in an append-only file with an index of the pages.  If
+  ``compress`` is one of ``COMPRESSORS`` pages are buffered by namespace and
+  written in independently compressed blocks.  The format of an existing
+  cache takes precedence.
+
+  Other storage backends override ``load()``, ``save()``, ``clear()``,
+  ``close()``, ``remap()``, ``merge()``, ``save_checkpoint()``, ``flush()``,
+  ``store()`` and ``read()`` and provide ``pages``, ``redirects``,
+  ``templates`` and ``revisions`` mappings.'''
+
+  def __init__(self, name_data, path, compress = None):
+    if compress is not None and compress not in COMPRESSORS:
+      raise Exception('Unknown cache compression %s' % compress)
+
     self.name_data    = name_data
     self.path         = path
+    self.compress     = compress
 
+    self.blocks       = array.array('Q') # File offset and size of blocks
+    self.pending      = {} # Namespace -> (block, chunks, size) not written
+    self.unpacked     = collections.OrderedDict() # Decompressed blocks
     self.buf          = None
+    self.view         = None # Mapping of the cache file, see remap()
     self.offset       = 0
     self.pages        = {}
     self.redirects    = {}
     self.templates    = {}
+    self.revisions    = {}
     self.rev_redirect = None
+    self.complete     = False
+    self.checkpoint   = None
 
     self.load()
 
 
   def load(self):
-    buf_path  = self.path + '/cache'
-    info_path = buf_path + '.pickle'
+    buf_path   = self.path + '/cache'
+    index_path = buf_path + '.index'
+    info_path  = buf_path + '.pickle'
+    check_path = buf_path + '.checkpoint'
 
-    if os.path.exists(buf_path) and os.path.exists(info_path):
+    if os.path.exists(buf_path) and os.path.exists(index_path):
+      self.load_index(index_path)
+      self.complete = True
+
+    elif os.path.exists(buf_path) and os.path.exists(info_path):
+      # Cache saved by an older version
       with open(info_path, 'rb') as f: data = pickle.load(f)
-      self.pages, self.redirects, self.templates = data
+      self.pages, self.redirects, self.templates = data[:3]
+      if 3 < len(data): self.revisions = data[3]
+      self.compress = None
+      self.complete = True
+
+    elif os.path.exists(buf_path):
+      # Resume an interrupted load from its last checkpoint and drop any
+      # pages written after it
+      offset = 0
+
+      if os.path.exists(check_path):
+        with open(check_path, 'rb') as f: data = pickle.load(f)
+        offset, self.pages, self.redirects, self.templates, \
+          self.revisions, self.checkpoint, self.compress, self.blocks = data
+
+      os.truncate(buf_path, offset)
 
     self.buf = open(buf_path, 'ab+', buffering = 0)
     self.offset = self.buf.tell()
 
 
+  def load_index(self, path):
+    '''Maps the page index.  Lookups run directly against the mapped file
+    and changes are kept in memory until the next ``save()``.'''
+    mm, header = open_index(path)
+    tables = header['tables']
+    models = header['info']['models']
+
+    self.compress = header['info']['compress']
+    self.blocks   = array.array('Q', map_array(mm, header['arrays']['blocks']))
+
+    def page(record):
+      model, offset, size = record
+      return models[model], offset, size
+
+    self.pages     = OverlayDict(MappedTable(mm, tables['pages'], page))
+    self.redirects = OverlayDict(MappedTable(mm, tables['redirects']))
+    self.templates = OverlayDict(
+      MappedTable(mm, tables['templates'], memo = True))
+    self.revisions = OverlayDict(
+      MappedTable(mm, tables['revisions'], _decode_revision))
+
+
   def save(self):
-    with open(self.path + '/cache.pickle', 'wb') as f:
-      pickle.dump((self.pages, self.redirects, self.templates), f)
+    '''Writes the page index as sorted tables of titles with fixed-width
+    page records.'''
+    self.flush()
+
+    models = sorted({model for model, offset, size in self.pages.values()})
+    ids    = {model: i for i, model in enumerate(models)}
+
+    def page(value):
+      model, offset, size = value
+      return ids[model], offset, size
+
+    revisions = ((title, _encode_revision(info))
+                 for title, info in self.revisions.items())
+
+    write_index(self.path + '/cache.index', dict(
+      pages     = (self.pages.items(), '<BQQ', page),
+      redirects = (self.redirects.items(), None, None),
+      templates = (self.templates.items(), None, None),
+      revisions = (revisions, None, None)),
+      dict(models = models, compress = self.compress),
+      dict(blocks = self.blocks))
+
+    for name in ('pickle', 'checkpoint'):
+      path = self.path + '/cache.' + name
+      if os.path.exists(path): os.remove(path)
+
+    self.complete   = True
+    self.checkpoint = None
+
+
+  def clear(self):
+    '''Removes all pages, the page index and any checkpoint.'''
+    for name in ('index', 'pickle', 'checkpoint'):
+      path = self.path + '/cache.' + name
+      if os.path.exists(path): os.remove(path)
+
+    self.buf.truncate(0)
+    self.view         = None
+    self.blocks       = array.array('Q')
+    self.pending      = {}
+    self.unpacked.clear()
+    self.offset       = 0
+    self.pages        = {}
+    self.redirects    = {}
+    self.templates    = {}
+    self.revisions    = {}
+    self.rev_redirect = None
+    self.complete     = False
+    self.checkpoint   = None
+
+
+  def close(self):
+    self.view = None
+    self.buf.close()
+
+
+  def remap(self):
+    '''Maps the cache file so pages are read without a syscall per page.
+    Mapping before forking shares it with the worker processes.'''
+    self.view = None
+    if self.offset:
+      self.view = memoryview(
+        mmap.mmap(self.buf.fileno(), 0, access = mmap.ACCESS_READ))
+
+
+  def merge(self, other):
+    '''Appends the pages of another saved cache with the same format.
+    Pages in ``other`` replace pages with the same title.'''
+    if other.compress != self.compress:
+      raise Exception('Cannot merge caches with different compression')
+
+    self.flush()
+    base = self.offset
+
+    other.buf.seek(0)
+    shutil.copyfileobj(other.buf, self.buf, 1 << 24)
+    self.offset += other.offset
+
+    # Compressed pages are located by block
+    if self.compress:
+      shift = len(self.blocks) // 2 << 32
+
+      for i in range(0, len(other.blocks), 2):
+        self.blocks.extend((base + other.blocks[i], other.blocks[i + 1]))
+
+    else: shift = base
+
+    for title, (model, offset, size) in other.pages.items():
+      self.pages[title] = (model, shift + offset, size)
+
+    self.redirects.update(other.redirects)
+    self.templates.update(other.templates)
+    self.revisions.update(other.revisions)
+    self.rev_redirect = None
+
+
+  def save_checkpoint(self, checkpoint):
+    '''Saves the page index along with the reader ``checkpoint`` so that
+    an interrupted load can be resumed.  Page data is synced to disk first
+    so the index never refers to data that was not written.'''
+    self.flush()
+    os.fsync(self.buf.fileno())
+
+    path = self.path + '/cache.checkpoint'
+    data = (self.offset, self.pages, self.redirects, self.templates,
+            self.revisions, checkpoint, self.compress, self.blocks)
+
+    with open(path + '.tmp', 'wb') as f:
+      pickle.dump(data, f)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.replace(path + '.tmp', path)
+    self.checkpoint = checkpoint
 
 
   def has_template(self, title):
@@ -164,7 +371,9 @@ class PageCache:
       self.set_template(redir, text)
 
 
-  def redirect_templates(self):
+  def redirect_templates(self, refresh = False):
+    '''Copies template bodies to the templates which redirect to them.  If
+    ``refresh`` is True previously copied bodies are replaced.'''
     prefix = self.name_data.get_name('Template') + ':'
 
     for k, v in self.redirects.items():
@@ -173,6 +382,7 @@ class PageCache:
       k = self.name_data.canonicalize_template_name(k)
       v = self.name_data.canonicalize_template_name(v)
 
+      if refresh: self.templates.pop(k, None)
       if k in self.templates or v not in self.templates: continue
 
       self.templates[k] = self.templates[v]
@@ -193,20 +403,43 @@ class PageCache:
     return False
 
 
-  def add(self, model, title, text):
+  def has_revision(self, title, info):
+    '''Returns True if the cached page has the content of the revision
+    with metadata ``info``.'''
+    old = self.revisions.get(title)
+    if old is None or info is None: return False
+
+    # Compare content hashes if available, otherwise revision ids
+    if old[3] and info[3]: return old[3] == info[3]
+    return old[1] == info[1]
+
+
+  def remove(self, title):
+    '''Tombstones a page by removing it from the index.  Its data stays
+    in the cache file.'''
+    if self.pages.pop(title, None) is None: return
+
+    self.redirects.pop(title, None)
+    self.revisions.pop(title, None)
+    self.rev_redirect = None
+
+    if title.startswith(self.name_data.get_name('Template') + ':'):
+      name = self.name_data.canonicalize_template_name(title)
+      self.templates.pop(name, None)
+
+
+  def add(self, model, title, text, info = None):
+    '''Appends a page.  ``info`` is its optional ``(id, revid, timestamp,
+    sha1)`` revision metadata.'''
     assert isinstance(model, str)
     assert isinstance(title, str)
     assert isinstance(text,  str)
 
-    # Save page
-    raw = text.encode('utf-8')
-    os.pwrite(self.buf.fileno(), raw, self.offset)
-    self.pages[title] = (model, self.offset, len(raw))
-    self.offset += len(raw)
+    self.store(model, title, text, info)
 
-    if model == 'redirect': self.redirects[title] = text
+    if model == 'redirect': return
 
-    elif title.startswith(self.name_data.get_name('Template') + ':'):
+    if title.startswith(self.name_data.get_name('Template') + ':'):
       # XXX These are insufficient for other languages
       if title.endswith('/documentation') or title.endswith('/testcases'):
         return
@@ -214,12 +447,99 @@ class PageCache:
       self.add_template(title, text)
 
 
+  def namespace(self, title):
+    i = title.find(':')
+    if i != -1 and self.name_data.get(title[:i]): return title[:i]
+    return ''
+
+
+  def write(self, title, raw):
+    '''Appends page data and returns its offset.  Compressed pages are
+    buffered by namespace and their offset is the block number in the high
+    32 bits and the offset in the uncompressed block in the low bits.'''
+    if not self.compress:
+      offset = self.offset
+      os.pwrite(self.buf.fileno(), raw, offset)
+      self.offset += len(raw)
+      return offset
+
+    ns = self.namespace(title)
+
+    if ns in self.pending: block, chunks, size = self.pending[ns]
+    else:
+      block, chunks, size = len(self.blocks) // 2, [], 0
+      self.blocks.extend((0, 0))
+
+    chunks.append(raw)
+    self.pending[ns] = block, chunks, size + len(raw)
+
+    limit = BLOCK_SIZE
+    if ns in (self.name_data.get_name('Template'),
+              self.name_data.get_name('Module')): limit = SMALL_BLOCK_SIZE
+
+    if limit <= size + len(raw): self.flush(ns)
+
+    return block << 32 | size
+
+
+  def flush(self, ns = None):
+    '''Compresses and writes the buffered pages of namespace ``ns`` or of
+    all namespaces.'''
+    for ns in list(self.pending) if ns is None else [ns]:
+      block, chunks, size = self.pending.pop(ns)
+      data = COMPRESSORS[self.compress][0](b''.join(chunks))
+
+      os.pwrite(self.buf.fileno(), data, self.offset)
+      self.blocks[2 * block]     = self.offset
+      self.blocks[2 * block + 1] = len(data)
+      self.offset += len(data)
+
+
+  def store(self, model, title, text, info):
+    '''Saves a page and its revision metadata.'''
+    raw = text.encode('utf-8')
+    self.pages[title] = (model, self.write(title, raw), len(raw))
+
+    if info is not None: self.revisions[title] = info
+    if model == 'redirect': self.redirects[title] = text
+
+
+  def read_block(self, block):
+    if block in self.unpacked:
+      self.unpacked.move_to_end(block)
+      return self.unpacked[block]
+
+    for pending, chunks, size in self.pending.values():
+      if pending == block: return b''.join(chunks)
+
+    offset, size = self.blocks[2 * block : 2 * block + 2]
+    if self.view is None or len(self.view) < offset + size: self.remap()
+
+    data = COMPRESSORS[self.compress][1](self.view[offset : offset + size])
+
+    self.unpacked[block] = data
+    if BLOCK_CACHE < len(self.unpacked): self.unpacked.popitem(last = False)
+
+    return data
+
+
   def read(self, title):
     '''Reads page contents. Returns None if the page does not exist.'''
     assert isinstance(title, str)
 
     if title.startswith('Main:'): title = title[5:]
 
-    if title in self.pages:
-      model, offset, size = self.pages[title]
-      return os.pread(self.buf.fileno(), size, offset).decode('utf-8')
+    page = self.pages.get(title)
+    if page is not None:
+      model, offset, size = page
+      if not size: return ''
+
+      if self.compress:
+        pos  = offset & 0xffffffff
+        data = memoryview(self.read_block(offset >> 32))
+        return str(data[pos : pos + size], 'utf-8')
+
+      # The file grows while loading
+      if self.view is None or len(self.view) < offset + size: self.remap()
+
+      with self.view[offset : offset + size] as data: return str(data, 'utf-8')
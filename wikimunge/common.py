@@ -164,6 +164,9 @@ MAGIC_FIRST       = 0x0010203e
 MAGIC_LAST        = 0x0010fff0
 MAX_MAGICS        = MAGIC_LAST - MAGIC_FIRST + 1
 
+# Message levels, messages below the level of a context are dropped
+DEBUG, WARNING, ERROR = range(3)
+
 # Mappings performed for text inside <nowiki>...</nowiki>
 _nowiki_map = {
   ';': '&semi;',
@@ -190,3 +193,26 @@ def nowiki_quote(text):
   '''Quote text inside <nowiki>...</nowiki> by escaping certain characters.'''
   def repl(m): return _nowiki_map[m.group(0)]
   return re.sub(_nowiki_re, repl, text)
+
+
+# Section headings, e.g. "== Heading ==" on a line of its own, which may
+# end with comments
+_heading_re = re.compile(r'(?m)^(={1,6})[ \t]*(.*?)[ \t]*(={1,6})'
+                         r'(?:[ \t]*<!--.*?-->)*[ \t\r]*$')
+
+def find_section(text, heading, level = 2):
+  '''Returns the section of text under heading at level, including the
+  heading line, up to the next heading at the same or a higher level.
+  Returns None if there is no such section.  The headings are found in a
+  single scan of the text.'''
+  start = None
+
+  for m in _heading_re.finditer(text):
+    depth = min(len(m.group(1)), len(m.group(3)))
+    if level < depth: continue
+
+    if start is not None: return text[start : m.start()]
+
+    if depth == level and m.group(2) == heading: start = m.start()
+
+  if start is not None: return text[start:]
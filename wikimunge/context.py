@@ -1,15 +1,41 @@
+import re
 import sys
+import time
 
 from .cache     import PageCache
 from .wikinode  import NodeKind
-from .common    import MAGIC_FIRST, MAX_MAGICS
+from .common    import MAGIC_FIRST, MAGIC_LAST, MAX_MAGICS
+from .common    import DEBUG, WARNING, ERROR
 from .encoder   import encode
+from .plan      import TemplatePlan
+from .memo      import TemplateMemo
+from .profiler  import Profiler
 from .expander  import expand
 from .parser    import parse
 
 
+_cookie_re = re.compile('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST))
+
+# Cookies with longer arguments are not deduplicated
+MAX_DEDUP_LENGTH = 256
+
+# Names of the message levels
+LEVELS = {'DEBUG': DEBUG, 'WARNING': WARNING, 'ERROR': ERROR}
+
+# Default limits on the expansion of a page, as in MediaWiki.  A limit of
+# None is not enforced.
+LIMITS = {
+  'include_size':    2 * 1024 * 1024, # Characters of expanded calls
+  'template_calls':  100000,          # Template and parser function calls
+  'expensive_calls': 500,             # See parserfns.EXPENSIVE_FUNCTIONS
+  'expand_time':     120,             # Seconds from start_page()
+}
+
+
 class Context(object):
-  def __init__(self, name_data, cache, template_filter = None, log = None):
+  def __init__(self, name_data, cache, template_filter = None, log = None,
+               memo_size = 0, limits = None, profile = False, rope = False,
+               log_level = 'DEBUG'):
     self.name_data         = name_data
     self.cache             = cache
     self.template_filter   = template_filter
@@ -20,10 +46,34 @@ class Context(object):
     self.lua_depth         = 0
     self.lua_invoke        = None
     self.lua_reset_env     = None
+    self.template_plans    = {} # Template body -> TemplatePlan
+    self.page_dependent    = 0  # Reads of the page title, time or caller
+    self.message_count     = 0
+    self.limits            = dict(LIMITS, **(limits or {}))
+    self.rope              = rope # Expand into the output list of the caller
+
+    # DEBUG messages are only written to the log
+    self.level = LEVELS[log_level]
+    if log is None: self.level = max(self.level, WARNING)
+
+    # Template expansions, disabled if memo_size is 0
+    self.template_memo = TemplateMemo(self, memo_size) if memo_size else None
+
+    # Time spent in templates and parser functions, if profiling
+    self.profiler = Profiler() if profile else None
 
 
   def message(self, kind, msg, trace):
-    if self.expand_stack: msg += ' at {}'.format(self.expand_stack)
+    '''Writes a message with the expansion and parser stacks, unless
+    ``kind`` is below the level of the context.  Entries of
+    ``expand_stack`` are strings or tuples of a format string and its
+    arguments, which are only formatted here.'''
+    if LEVELS[kind] < self.level: return
+
+    if self.expand_stack:
+      stack = [x[0].format(*x[1:]) if isinstance(x, tuple) else x
+               for x in self.expand_stack]
+      msg += ' at {}'.format(stack)
 
     if self.parser_stack:
       titles = []
@@ -35,15 +85,18 @@ class Context(object):
           lst = [x if isinstance(x, str) else '???' for x in node.args[0]]
           title = ''.join(lst)
           titles.append(title.strip())
-          msg += ' parsing ' + '/'.join(titles)
+
+      if titles: msg += ' parsing ' + '/'.join(titles)
 
     if trace: msg += '\n' + trace
 
     msg = '%s: %s: %s' % (self.title, kind, msg)
+    self.message_count += 1
 
+    # DEBUG messages are left in the log buffer
     if self.log:
       self.log.write(msg + '\n')
-      self.log.flush()
+      if kind != 'DEBUG': self.log.flush()
 
     if kind != 'DEBUG':
       sys.stderr.write(msg + '\n')
@@ -51,16 +104,26 @@ class Context(object):
 
 
   def error(  self, msg, trace = None): self.message('ERROR',   msg, trace)
-  def warning(self, msg, trace = None): self.message('WARNING', msg, trace)
-  def debug(  self, msg, trace = None): self.message('DEBUG',   msg, trace)
+
+  def warning(self, msg, trace = None):
+    if self.level <= WARNING: self.message('WARNING', msg, trace)
+
+  def debug(  self, msg, trace = None):
+    if self.level <= DEBUG: self.message('DEBUG', msg, trace)
+
+
+  def has_cookie(self, idx):
+    return (0 <= idx and idx < len(self.cookies) and
+            self.cookies[idx] is not None)
 
 
-  def has_cookie(self,  idx): return 0 <= idx and idx < len(self.cookies)
   def load_cookie(self, idx): return self.cookies[idx]
 
 
   def save_cookie(self, kind, args, nowiki):
-    '''Saves a value and returns a unique magic cookie for it.'''
+    '''Saves a value and returns a magic cookie for it in the current
+    scope, see ``push_cookie_scope()``.  Values with short arguments get
+    the same cookie as long as it is in use.'''
     assert kind in (
       'T',  # Template {{ ... }}
       'A',  # Template argument {{{ ... }}}
@@ -73,19 +136,80 @@ class Context(object):
 
     v = (kind, tuple(args), nowiki)
 
-    if v in self.rev_ht: return self.rev_ht[v]
-    idx = len(self.cookies)
+    # Hashing long arguments would cost more than duplicate cookies
+    dedup = sum(map(len, v[1])) <= MAX_DEDUP_LENGTH
+    if dedup:
+      ch = self.rev_ht.get(v)
+      if ch is not None:
+        # A cookie of a deeper scope must now live as long as this one
+        self.keep_cookies((ch,), self.cookie_scope)
+        return ch
+
+    if self.free_cookies: idx = self.free_cookies.pop()
+    else:
+      idx = len(self.cookies)
 
-    if MAX_MAGICS <= idx:
-      self.error('too many templates, arguments, or parser function calls')
-      return ''
+      if MAX_MAGICS <= idx:
+        self.error('too many templates, arguments, or parser function calls')
+        return ''
 
-    self.cookies.append(v)
+      self.cookies.append(None)
+      self.cookie_owner.append(None)
+
+    self.cookies[idx]      = v
+    self.cookie_owner[idx] = self.cookie_scope
+    self.cookie_scopes[self.cookie_scope].add(idx)
+
+    ch = chr(MAGIC_FIRST + idx)
+    if dedup: self.rev_ht[v] = ch
 
-    ch = self.rev_ht[v] = chr(MAGIC_FIRST + idx)
     return ch
 
 
+  def push_cookie_scope(self):
+    '''Opens a scope for the cookies saved while expanding a template body.
+    Returns the current scope, to pass to ``pop_cookie_scope()``.'''
+    scope = self.cookie_scope
+    self.cookie_scope = len(self.cookie_scopes)
+    self.cookie_scopes.append(set())
+
+    return scope
+
+
+  def pop_cookie_scope(self, texts, scope):
+    '''Closes the innermost cookie scope and makes ``scope`` current
+    again.  The cookies of the closed scope that the strings ``texts``
+    refer to move to ``scope``, the others are released and their codes
+    reused.'''
+    if self.cookie_scopes[-1]: self.keep_cookies(texts, scope)
+
+    for idx in self.cookie_scopes.pop():
+      v = self.cookies[idx]
+      self.cookies[idx] = self.cookie_owner[idx] = None
+      self.free_cookies.append(idx)
+
+      if self.rev_ht.get(v) == chr(MAGIC_FIRST + idx): del self.rev_ht[v]
+
+    self.cookie_scope = scope
+
+
+  def keep_cookies(self, texts, scope):
+    '''Moves the cookies in the strings ``texts``, and in their arguments,
+    that are in a scope deeper than ``scope`` to ``scope``.'''
+    todo = list(texts)
+
+    while todo:
+      for ch in _cookie_re.findall(todo.pop()):
+        idx   = ord(ch) - MAGIC_FIRST
+        owner = self.cookie_owner[idx] if idx < len(self.cookies) else None
+        if owner is None or owner <= scope: continue
+
+        self.cookie_scopes[owner].remove(idx)
+        self.cookie_scopes[scope].add(idx)
+        self.cookie_owner[idx] = scope
+        todo.extend(self.cookies[idx][1])
+
+
   def expand_template(self, title):
     if self.template_filter:
       title = self.name_data.canonicalize_template_name(title)
@@ -100,6 +224,17 @@ class Context(object):
 
 
   def encode(self, text): return encode(self, text)
+
+
+  def template_plan(self, body):
+    '''Returns the compiled plan of a template body.  Bodies are compiled
+    once and the plans are reused on every page.'''
+    plan = self.template_plans.get(body)
+
+    if plan is None: plan = self.template_plans[body] = TemplatePlan(body)
+
+    return plan
+
   def parse(self, text): return parse(self, text)
 
 
@@ -107,6 +242,29 @@ class Context(object):
     return expand(self, text, parent)
 
 
+  def over_limit(self, expensive = False):
+    '''Returns the name of the first limit of the page that has been
+    exceeded or None.  The count of expensive parser function calls is only
+    checked if ``expensive``.  Each limit is reported once per page.'''
+    costs = [
+      ('template_calls', self.template_calls),
+      ('include_size',   self.include_size),
+      ('expand_time',    time.time() - self.start_time)]
+    if expensive: costs.append(('expensive_calls', self.expensive_calls))
+
+    for name, value in costs:
+      limit = self.limits.get(name)
+      if limit is None or value <= limit: continue
+
+      if name not in self.limits_exceeded:
+        self.limits_exceeded.add(name)
+        self.error('{} limit of {} exceeded'.format(name, limit))
+
+      # Degraded expansions are not memoized
+      self.page_dependent += 1
+      return name
+
+
   def page_redirect(self, title): return self.cache.redirects.get(title)
   def page_exists(  self, title): return self.cache.exists(title)
   def read_by_title(self, title): return self.cache.read(title)
@@ -116,12 +274,24 @@ class Context(object):
     self.title                 = title
 
     # Magic cookies
-    self.cookies               = []
-    self.rev_ht                = {}
+    self.cookies               = [] # Index -> value, None if released
+    self.cookie_owner          = [] # Index -> scope
+    self.cookie_scopes         = [set()] # Indices of the open scopes
+    self.cookie_scope          = 0  # Scope of new cookies
+    self.free_cookies          = [] # Released indices
+    self.rev_ht                = {} # Short value -> cookie
 
     # Expand
     self.expand_stack          = [title]
 
+    # Expansion costs, see over_limit()
+    self.start_time            = time.time()
+    self.template_calls        = 0
+    self.expensive_calls       = 0
+    self.include_size          = 0
+    self.limits_exceeded       = set()
+    if self.profiler: self.profiler.reset()
+
     # Parse
     self.parser_stack          = []
     self.linenum               = None
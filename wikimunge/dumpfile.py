@@ -0,0 +1,111 @@
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import subprocess
+
+
+# Stdlib decompressors by file extension
+OPENERS = {
+  '.bz2': bz2.open,
+  '.gz':  gzip.open,
+  '.xz':  lzma.open,
+}
+
+# External parallel decompressors, in order of preference.  The first one
+# found on the PATH is used.
+DECOMPRESSORS = {
+  '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+  '.gz':  [['pigz', '-dc']],
+  '.xz':  [],
+}
+
+# Compressed stream signatures, used to detect the format of piped input
+MAGICS = (
+  (b'BZh',          '.bz2'),
+  (b'\x1f\x8b',     '.gz'),
+  (b'\xfd7zXZ\x00', '.xz'),
+)
+
+
+class DumpPipe:
+  '''Reads the output of an external decompressor process.'''
+
+  def __init__(self, cmd, path):
+    self.cmd  = cmd
+    self.proc = subprocess.Popen(
+      cmd + [path], stdout = subprocess.PIPE, bufsize = 1 << 20)
+    self.name = path
+
+
+  def read(self, size = -1):
+    data = self.proc.stdout.read(size)
+
+    if size and not data:
+      ret = self.proc.wait()
+      if ret: raise Exception('%s exited with %d' % (' '.join(self.cmd), ret))
+
+    return data
+
+
+  def seekable(self): return False
+
+
+  def close(self):
+    if self.proc.poll() is None: self.proc.kill()
+    self.proc.stdout.close()
+    self.proc.wait()
+
+
+  def __enter__(self): return self
+  def __exit__(self, *args): self.close()
+
+
+def find_decompressor(ext):
+  '''Returns the command of the first external decompressor for the given
+  file extension found on the PATH or None.'''
+  for cmd in DECOMPRESSORS.get(ext, []):
+    if shutil.which(cmd[0]): return cmd
+
+
+def open_stdin():
+  '''Opens stdin for binary reading and detects compressed input.'''
+  f = open(0, 'rb', closefd = False)
+  head = f.peek(8)
+
+  for magic, ext in MAGICS:
+    if head.startswith(magic): return OPENERS[ext](f)
+
+  return f
+
+
+def open_dump(path, external = True):
+  '''Opens a dump file for binary reading.  Compressed files are detected
+  by extension and decompressed with an external parallel decompressor if
+  ``external`` is True and one is available, otherwise with the stdlib.  A
+  path of ``-`` reads, possibly compressed, input from stdin.'''
+  if path == '-': return open_stdin()
+
+  ext = os.path.splitext(path)[1]
+
+  if ext in OPENERS:
+    cmd = find_decompressor(ext) if external else None
+    if cmd: return DumpPipe(cmd, path)
+
+    return OPENERS[ext](path)
+
+  return open(path, 'rb')
+
+
+def seek_dump(f, offset):
+  '''Moves forward to ``offset`` in the decompressed dump.  Input that
+  cannot seek is read and discarded up to that point.'''
+  if f.seekable():
+    f.seek(offset)
+    return
+
+  while offset:
+    data = f.read(min(offset, 1 << 22))
+    if not data: break
+    offset -= len(data)
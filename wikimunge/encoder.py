@@ -1,17 +1,31 @@
 import re
 
 from .common import MAGIC_FIRST, MAGIC_LAST, MAX_MAGICS, MAGIC_NOWIKI_CHAR
+from .common import DEBUG
 
 
-def encode(ctx, text):
-  '''Encode all templates, template arguments, and parser function calls
-  in the text, from innermost to outermost.'''
+def vbar_split(v):
+  '''Splits the contents of a template, argument or link at vertical bars
+  which are not inside HTML elements.'''
+  if '<' not in v: return v.split('|')
+  return list(m.group(1) for m in re.finditer(
+    r'(?si)\|((<\s*([-a-zA-z0-9]+)\b[^>]*>[^][{}]*?<\s*/\s*\3\s*>|'
+    r'[^|])*)', '|' + v))
 
-  def vbar_split(v):
-    return list(m.group(1) for m in re.finditer(
-      r'(?si)\|((<\s*([-a-zA-z0-9]+)\b[^>]*>[^][{}]*?<\s*/\s*\3\s*>|'
-      r'[^|])*)', '|' + v))
 
+def encode_passes(ctx, text, passes = None):
+  '''Encode all templates, template arguments, and parser function calls
+  in the text, from innermost to outermost, by applying regular expressions
+  until the text no longer changes.  Each pass encodes one more level of
+  nesting.  After ``passes`` passes, if not None, this gives up and returns
+  the partly encoded text and False, else the encoded text and True.  The
+  text must not contain comments.'''
+  count = 0
+
+  def give_up():
+    nonlocal count
+    count += 1
+    return passes is not None and passes < count
 
   def repl_arg(m):
     '''Replacement function for template arguments.'''
@@ -30,8 +44,9 @@ def encode(ctx, text):
     args = vbar_split(orig)
 
     # a single '}' needs to be escaped as '}}' with .format
-    ctx.debug('heuristically added missing }} to template arg {}'
-              .format(args[0].strip()))
+    if ctx.level <= DEBUG:
+      ctx.debug('heuristically added missing }} to template arg {}'
+                .format(args[0].strip()))
 
     return prefix + ctx.save_cookie('A', args, nowiki)
 
@@ -54,8 +69,9 @@ def encode(ctx, text):
     args   = vbar_split(v)
 
     # a single '}' needs to be escaped as '}}' with .format
-    ctx.debug('heuristically added missing }} to template {}'
-              .format(args[0].strip()))
+    if ctx.level <= DEBUG:
+      ctx.debug('heuristically added missing }} to template {}'
+                .format(args[0].strip()))
 
     return prefix + ctx.save_cookie('T', args, nowiki)
 
@@ -81,20 +97,23 @@ def encode(ctx, text):
 
   # Main loop of encoding.  We encode repeatedly, always the innermost
   # template, argument, or parser function call first.  We also encode
-  # links as they affect the interpretation of templates.
-  # As a preprocessing step, remove comments from the text.
-  text = re.sub(r'(?s)<!\s*--.*?--\s*>', '', text)
+  # links as they affect the interpretation of templates.  Giving up at the
+  # start of any loop leaves text that encodes the same as if we had gone
+  # on, so the rest can be encoded by encode_scan().
   while True:
+    if give_up(): return text, False
     prev = text
 
     # Encode template arguments.  We repeat this until there are
     # no more matches, because otherwise we could encode the two
     # innermost braces as a template transclusion.
     while True:
+      if give_up(): return text, False
       prev2 = text
 
       # Encode links.
       while True:
+        if give_up(): return text, False
         text = re.sub(
           r'(?s)\[' + MAGIC_NOWIKI_CHAR +
           r'?\[(([^][{}<>]|<[-+*a-zA-Z0-9]*>)+)\]' + MAGIC_NOWIKI_CHAR + r'?\]',
@@ -152,4 +171,516 @@ def encode(ctx, text):
 
     prev = text
 
-  return text
+  return text, True
+
+
+# Loops of encode_passes() before encode() scans the rest of the text
+ENCODE_PASSES = 16
+
+# Runs of brackets or braces, possibly with <nowiki /> between them
+_run_re       = re.compile(
+  r'\{(?:N?\{)*|\}(?:N?\})*|\[(?:N?\[)*|\](?:N?\])*'.replace(
+    'N', MAGIC_NOWIKI_CHAR))
+_split_braces = '{' + MAGIC_NOWIKI_CHAR + '{'
+_comment_re   = re.compile(r'(?s)<!\s*--.*?--\s*>')
+_cookie_re    = re.compile('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST))
+
+# Valid contents of links, external links, template arguments and templates
+# once everything inside them has been encoded, as in encode_passes()
+_link_re      = re.compile(r'(?s)(?:[^][{}<>]|<[-+*a-zA-Z0-9]*>)+')
+_extlink_re   = re.compile(r'(?s)[^][{}<>|]+')
+_arg_re       = re.compile(r'(?s)(?:[^{}]|\{\|[^{}]*\|\})*')
+_arg_err_re   = re.compile(r'(?s)[^{}]*')
+_templ_re     = re.compile(
+  r'(?s)(?:\{\|[^{}]*?\|\}|\}[^{}]|[^{}](?:\{[^{}|])?)+')
+_templ_err_re = re.compile(
+  r'(?s)([^{])\{' + MAGIC_NOWIKI_CHAR +
+  r'?\{((?:[^{}]|\{\|[^{}]*\|\}|\}[^{}])+?)\}')
+
+
+def _split_open(run, k):
+  '''Splits a run of opening brackets before its last ``k`` brackets.'''
+  if MAGIC_NOWIKI_CHAR not in run: return run[:-k], run[-k:]
+  i = len(run)
+  while k:
+    i -= 1
+    if run[i] != MAGIC_NOWIKI_CHAR: k -= 1
+  return run[:i], run[i:]
+
+
+def _split_close(run, k):
+  '''Splits a run of closing brackets after its first ``k`` brackets.'''
+  if MAGIC_NOWIKI_CHAR not in run: return run[:k], run[k:]
+  i = 0
+  while k:
+    if run[i] != MAGIC_NOWIKI_CHAR: k -= 1
+    i += 1
+  return run[:i], run[i:]
+
+
+def encode(ctx, text):
+  '''Encode all templates, template arguments, and parser function calls
+  in the text, from innermost to outermost.  Regular expressions encode
+  shallow text fastest, but take a pass over the text for every level of
+  nesting.  So after ENCODE_PASSES passes of ``encode_passes()`` any
+  deeper nesting is left to ``encode_scan()``.'''
+
+  # As a preprocessing step, remove comments from the text.
+  text = _comment_re.sub('', text)
+
+  text, done = encode_passes(ctx, text, ENCODE_PASSES)
+  return text if done else encode_scan(ctx, text)
+
+
+def encode_scan(ctx, text):
+  '''Encode all templates, template arguments, and parser function calls
+  in the text, from innermost to outermost.  The text is scanned with a
+  stack of open brackets and each construct is encoded when its closing
+  brackets are seen, following the rules and heuristics of
+  ``encode_passes()``.  The text is only scanned again if templates with a
+  missing closing brace were found.  The text must not contain comments.
+
+  A template that starts with a table, as in ``{{{||}}x}}``, may go on
+  past the braces which end the table and close a template inside it.
+  Such templates are held open until it is known whether
+  ``encode_passes()`` would encode them in the same pass as the inner
+  template, and so open the template at the leftmost braces.
+
+  Single brackets inside single brackets inside an argument, as in
+  ``{{{[ [b]]}}}``, still encode differently.  They are encoded from the
+  inside out, where the regular expressions encode the argument first.'''
+
+  # Encoded pieces of text and open brackets as [kind, count, index in out].
+  # Kinds are '{' and '[' for runs of braces and brackets, '|' for tables
+  # and 'x' for braces whose contents turned out to be invalid.
+  out   = []
+  stack = []
+
+  # Templates held open, see hold(), and the passes of encode_passes()
+  # which encode the cookies, see level()
+  pending = []
+  levels  = {}
+
+
+  def debug(msg):
+    '''Logs a debug message once the templates held open are settled.'''
+    if pending: pending[-1][-1].append(msg)
+    else: ctx.debug(msg)
+
+
+  def level(body):
+    '''Returns the iteration of the main loop of ``encode_passes()`` which
+    encodes a template with ``body``.  Arguments and links are encoded in
+    the same iteration as the templates around them.'''
+    todo = _cookie_re.findall(body)
+    while todo:
+      ch = todo[-1]
+      if ch in levels:
+        todo.pop()
+        continue
+
+      kind, args = ctx.cookies[ord(ch) - MAGIC_FIRST][:2]
+      inner      = _cookie_re.findall(''.join(args))
+      new        = [x for x in inner if x not in levels]
+      if new: todo.extend(new)
+      else:
+        todo.pop()
+        levels[ch] = 0 if kind == 'N' else (
+          max([1] + [levels[x] for x in inner]) + (kind == 'T'))
+
+    return max([1] + [levels[x] for x in _cookie_re.findall(body)])
+
+
+  def hold(i, j, run, count, bound):
+    '''Holds the braces of stack[i] open at the closing ``run``.  The two
+    after the first ``j`` of them may open a template which goes on after
+    the run, as a table in it ends at the first brace of the run.
+    ``bound`` is the level of the template the run would close instead,
+    if any.'''
+    frame = stack[i]
+    pending.append((frame, j, i, out[frame[2]:],
+                    [list(f) for f in stack[i + 1:]], run, count, pos,
+                    bound, []))
+
+
+  def settle():
+    '''Settles the innermost template held open.'''
+    messages = pending.pop()[-1]
+    if pending: pending[-1][-1].extend(messages)
+    else:
+      for msg in messages: ctx.debug(msg)
+
+
+  def rollback():
+    '''Closes the braces of the innermost template held open at the run
+    where it was held, as if without looking ahead.  The text after the
+    run is then scanned again.'''
+    nonlocal pos
+    frame, j, i, saved, above, run, count, pos = pending.pop()[:8]
+    out[frame[2]:] = saved
+    stack[i + 1:]  = above
+    close_braces(run, count, True)
+
+
+  def enclose(i, run, count, bound):
+    '''Makes the braces of stack[i], which a <nowiki /> splits, text of a
+    template opened by the braces below them.  Their second brace then
+    starts a table, which ends before the closing ``run`` or at its first
+    brace.  ``bound`` is the level of the template the run would close
+    instead, if any.  Returns the rest of the run, or None if no template
+    can be opened below.'''
+    k = i - 1
+    while 0 <= k and stack[k][0] == '[': k -= 1
+    if k < 0 or stack[k][0] != '{': return None
+
+    frame = stack[k]
+    held  = pending and pending[-1][0] is frame
+    inner = ''.join(out[frame[2] + 1:])
+    for j in [pending[-1][1]] if held else range(frame[1] - 1):
+      opened = _split_open(out[frame[2]], frame[1] - j)[1]
+      body   = _split_close(opened, 2)[1] + inner
+      if _templ_re.fullmatch(body): closed = ''
+      elif 3 <= count and _templ_re.fullmatch(body + run[0]):
+        closed = run[:len(run) - len(run[1:].lstrip(MAGIC_NOWIKI_CHAR))]
+      elif (count == 2 and _templ_re.fullmatch(
+          body + run + text[pos:pos + 1].replace('{', ' '))):
+        closed = None
+      else: continue
+      break
+
+    else: return None
+
+    # The template may go on after the run, as in hold()
+    if closed is None:
+      hold(k, j, run, count, bound)
+      del stack[k + 1:]
+      out.append(run)
+      return ''
+
+    if bound is not None and bound < level(body): return None
+
+    del stack[k + 1:]
+    if closed: out.append(closed)
+    return run[len(closed):]
+
+
+  def close(i, kind, args, k_open, run, k_close, nowiki):
+    '''Replaces the last ``k_open`` brackets of stack[i] and everything after
+    them by a cookie.  Returns the rest of the closing ``run``.'''
+    frame        = stack[i]
+    idx          = frame[2]
+    left, opened = _split_open(out[idx], k_open)
+    closed, run  = _split_close(run, k_close)
+
+    nowiki = (nowiki or MAGIC_NOWIKI_CHAR in opened or
+              MAGIC_NOWIKI_CHAR in closed)
+    cookie = ctx.save_cookie(kind, args, nowiki)
+
+    del out[idx:]
+    del stack[i + 1:]
+
+    # The remaining brackets stay open, a <nowiki /> between them and the
+    # cookie is text inside them.  A single brace is text.
+    count = frame[1] - k_open
+    if count:
+      brackets = left.rstrip(MAGIC_NOWIKI_CHAR)
+      out.append(brackets)
+      if left != brackets: out.append(left[len(brackets):])
+
+    if count >= (2 if frame[0] == '{' else 1): frame[1] = count
+    else: stack.pop()
+    out.append(cookie)
+
+    rest = run.lstrip(MAGIC_NOWIKI_CHAR)
+    if run != rest: out.append(run[:len(run) - len(rest)])
+
+    return rest
+
+
+  def before(frame, k):
+    '''Returns the character before the last ``k`` brackets of a frame or
+    None.'''
+    left = _split_open(out[frame[2]], k)[0]
+    if left: return left[-1]
+    if frame[2]: return out[frame[2] - 1][-1]
+
+
+  def close_braces(run, count, eager = False):
+    '''Closes braces with the closing ``run`` of ``count`` braces.  Returns
+    True if a template held open was closed at an earlier run instead,
+    after which the text must be scanned from ``pos``.  If ``eager`` the
+    run closes the innermost braces without looking ahead.'''
+    while count:
+      # The vertical bar of a table closes it with one brace, brackets
+      # inside it are text and so is a <nowiki /> after it
+      i = len(stack) - 1
+      while 0 <= i and stack[i][0] == '[': i -= 1
+      if 0 <= i and stack[i][0] == '|' and out[-1][-1] == '|':
+        del stack[i:]
+        rest   = run[1:].lstrip(MAGIC_NOWIKI_CHAR)
+        out.append(run[:len(run) - len(rest)])
+        run    = rest
+        count -= 1
+        continue
+
+      if count < 2: break
+
+      # Find the innermost braces, brackets inside them are text
+      i = len(stack) - 1
+      while 0 <= i and stack[i][0] in '[|': i -= 1
+      if i < 0 or stack[i][0] == 'x': break
+
+      frame = stack[i]
+      n     = frame[1]
+      body  = ''.join(out[frame[2] + 1:])
+
+      # The brace after the leftmost three may start a table in the
+      # argument, which the first closing brace may end
+      table = ''
+      if 4 <= n and body.startswith('|'):
+        table = _split_close(_split_open(out[frame[2]], 4)[1], 3)[1]
+
+      if (table and 4 <= count and not _arg_re.fullmatch(table + body) and
+          _arg_re.fullmatch(table + body + '}')):
+        closed = run[:len(run) - len(run[1:].lstrip(MAGIC_NOWIKI_CHAR))]
+        out.append(closed)
+        body  += closed
+        run    = run[len(closed):]
+        count -= 1
+
+      if table and 3 <= count and _arg_re.fullmatch(table + body):
+        body   = table + body
+        run    = close(i, 'A', vbar_split(body), 4, run, 3,
+                       MAGIC_NOWIKI_CHAR in body)
+        count -= 3
+
+      elif 3 <= n and 3 <= count and _arg_re.fullmatch(body):
+        run    = close(i, 'A', vbar_split(body), 3, run, 3,
+                       MAGIC_NOWIKI_CHAR in body)
+        count -= 3
+
+      elif (3 <= n and count == 2 and _arg_err_re.fullmatch(body) and
+            before(frame, 3) not in ('{', None)):
+        # Template arguments with one missing closing brace are so common
+        # in Wiktionary that they might be allowed by the MediaWiki parser
+        args = vbar_split(body)
+        if ctx.level <= DEBUG:
+          debug('heuristically added missing }} to template arg {}'
+                .format(args[0].strip()))
+        nowiki = (MAGIC_NOWIKI_CHAR in body or
+                  before(frame, 3) == MAGIC_NOWIKI_CHAR)
+        run    = close(i, 'A', args, 3, run, 2, nowiki)
+        count -= 2
+
+      else:
+        # The leftmost two braces with valid contents open a template, the
+        # braces after them may start a table.  Braces held open only open
+        # the template they were held open for.
+        held     = pending and pending[-1][0] is frame
+        brackets = out[frame[2]]
+        ahead    = None
+        for j in [pending[-1][1]] if held else range(n - 1):
+          left, opened = _split_open(brackets, n - j)
+          opened, rest = _split_close(opened, 2)
+          if _templ_re.fullmatch(rest + body): break
+
+          # The table may end at the first closing brace and the template
+          # go on after the run.  Braces after the run may be encoded
+          # before the template.
+          if (ahead is None and not held and not eager and
+              _templ_re.fullmatch(rest + body + run +
+                                  text[pos:pos + 1].replace('{', ' '))):
+            ahead = j
+
+        else:
+          if brackets == _split_braces and not eager:
+            tail = enclose(i, run, count, None)
+            if tail is not None:
+              run   = tail
+              count = len(run) - run.count(MAGIC_NOWIKI_CHAR)
+              continue
+
+          # A brace followed by a <nowiki /> is text in a template, as the
+          # <nowiki /> splits the run of closing braces
+          if run[1] == MAGIC_NOWIKI_CHAR:
+            out.append(run[:2])
+            run    = run[2:]
+            count -= 1
+            continue
+
+          if ahead is not None:
+            hold(i, ahead, run, count, None)
+            break
+
+          if held:
+            rollback()
+            return True
+
+          frame[0] = 'x'
+          break
+
+        # encode_passes() only opens the template at the braces held open
+        # if it encodes it in the same pass as the templates closed instead
+        if held:
+          value = level(rest + body)
+          while pending and pending[-1][0] is frame:
+            bound = pending[-1][-2]
+            if bound is not None and bound < value:
+              rollback()
+              return True
+
+            settle()
+
+        elif ahead is not None:
+          hold(i, ahead, run, count, level(rest + body))
+          break
+
+        elif brackets == _split_braces and not eager:
+          tail = enclose(i, run, count, level(rest + body))
+          if tail is not None:
+            run   = tail
+            count = len(run) - run.count(MAGIC_NOWIKI_CHAR)
+            continue
+
+        if rest:
+          out[frame[2]:frame[2] + 1] = [left + opened, rest]
+          frame[1] = j + 2
+          body = rest + body
+
+        run    = close(i, 'T', vbar_split(body), 2, run, 2,
+                       MAGIC_NOWIKI_CHAR in body)
+        count -= 2
+
+    if run: out.append(run)
+
+
+  def close_brackets(run, count):
+    while count and stack and stack[-1][0] == '[':
+      frame = stack[-1]
+      body  = ''.join(out[frame[2] + 1:])
+
+      if 2 <= frame[1] and 2 <= count and _link_re.fullmatch(body):
+        run    = close(len(stack) - 1, 'L', vbar_split(body), 2, run, 2,
+                       MAGIC_NOWIKI_CHAR in body)
+        count -= 2
+
+      elif _extlink_re.fullmatch(body):
+        run    = close(len(stack) - 1, 'E', [body], 1, run, 1,
+                       MAGIC_NOWIKI_CHAR in body)
+        count -= 1
+
+      else:
+        stack.pop()
+        break
+
+    if run: out.append(run)
+
+
+  def repl_templ_err(m):
+    '''Replacement function for templates with a missing closing brace.'''
+    nowiki = m.group(0).find(MAGIC_NOWIKI_CHAR) >= 0
+    args   = vbar_split(m.group(2))
+
+    # a single '}' needs to be escaped as '}}' with .format
+    if ctx.level <= DEBUG:
+      ctx.debug('heuristically added missing }} to template {}'
+                .format(args[0].strip()))
+
+    return m.group(1) + ctx.save_cookie('T', args, nowiki)
+
+
+  while True:
+    pos = 0
+
+    while True:
+      for m in _run_re.finditer(text, pos):
+        start = m.start()
+        if pos < start: out.append(text[pos:start])
+        pos = m.end()
+
+        run   = m.group()
+        count = len(run) - run.count(MAGIC_NOWIKI_CHAR)
+
+        if run[0] == '{':
+          # A single brace is text unless it starts a table
+          if 1 < count: stack.append(['{', count, len(out)])
+          elif text.startswith('|', pos): stack.append(['|', 1, len(out)])
+          out.append(run)
+
+        elif run[0] == '[':
+          stack.append(['[', count, len(out)])
+          out.append(run)
+
+        elif run[0] == '}':
+          if close_braces(run, count): break
+        else: close_brackets(run, count)
+
+      else:
+        # Templates still held open at the end of the text are closed
+        # where they were held open
+        if not pending: break
+        rollback()
+
+    if pos < len(text): out.append(text[pos:])
+
+    text = ''.join(out)
+
+    # When everything else has been done, see if we can find template calls
+    # that have one missing closing brace.  Their cookies may complete the
+    # brackets around them, so the text is scanned again.
+    if not any(frame[0] in '{x' for frame in stack): return text
+
+    prev = text
+    text = _templ_err_re.sub(repl_templ_err, text)
+    if text == prev: return text
+
+    del out[:]
+    del stack[:]
+
+
+class CookieTable:
+  '''A cookie table for encoding text outside of a page.'''
+
+  def __init__(self):
+    self.cookies  = []
+    self.rev_ht   = {}
+    self.messages = []    # Debug messages
+    self.level    = DEBUG # All messages are kept
+
+
+  def debug(self, msg): self.messages.append(msg)
+
+
+  def save_cookie(self, kind, args, nowiki):
+    v = (kind, tuple(args), nowiki)
+
+    if v not in self.rev_ht:
+      self.rev_ht[v] = chr(MAGIC_FIRST + len(self.cookies))
+      self.cookies.append(v)
+
+    return self.rev_ht[v]
+
+
+class EncodedText(CookieTable):
+  '''Text encoded with a private cookie table.  ``relocate()`` copies
+  cookies into the cookie table of a page as if the text had been encoded
+  there, repeating the debug messages of the encoding.'''
+
+  def __init__(self, text):
+    super().__init__()
+    self.text = encode(self, text)
+
+
+  def relocate(self, ctx, text, table):
+    '''Copies the cookies in ``text``, which is part of the encoded text,
+    into the cookie table of a page and returns ``text`` renumbered for
+    that page.  ``table`` maps the cookies copied so far.'''
+    for ch in _cookie_re.findall(text):
+      i = ord(ch) - MAGIC_FIRST
+      if MAGIC_FIRST + i in table: continue
+
+      kind, args, nowiki = self.cookies[i]
+      args = [self.relocate(ctx, arg, table) for arg in args]
+      table[MAGIC_FIRST + i] = ctx.save_cookie(kind, args, nowiki)
+
+    return text.translate(table)
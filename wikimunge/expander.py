@@ -1,12 +1,23 @@
 import re
+import time
 import html
+import functools
+import collections.abc
 
 from .encoder   import encode
-from .parserfns import call_parser_function, PARSER_FUNCTIONS
-from .common    import MAGIC_NOWIKI_CHAR, MAGIC_FIRST, MAGIC_LAST
+from .plan      import arg_key
+from .parserfns import parser_function, PARSER_FUNCTIONS, \
+  PAGE_DEPENDENT_FUNCTIONS, EXPENSIVE_FUNCTIONS
+from .common    import MAGIC_NOWIKI_CHAR, MAGIC_FIRST, MAGIC_LAST, DEBUG
 from .luaexec   import call_lua_sandbox
 
 
+_cookie_re    = re.compile('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST))
+_magic_re     = re.compile(
+  '[%s%c-%c]' % (MAGIC_NOWIKI_CHAR, MAGIC_FIRST, MAGIC_LAST))
+_named_arg_re = re.compile(r'(?s)^\s*([^][&<>="\']+?)\s*=\s*(.*?)\s*$')
+
+
 def _unexpanded_template(args, nowiki):
   '''Formats an unexpanded template (whose arguments may have been
     partially or fully expanded).'''
@@ -39,6 +50,85 @@ def _unexpanded_extlink(args, nowiki):
   return '[' + '|'.join(args) + ']'
 
 
+def _run(frame, *args):
+  '''Runs an expansion frame and returns its value.  Frames are generators
+  which yield the frames whose values they need, so nested templates,
+  arguments and links are expanded on an explicit work stack instead of
+  the Python stack.  An exception is thrown into the frames below the one
+  that raised it, so they can clean up as if they had called it.  If
+  ``args`` are given, the frame is made by calling ``frame`` with them.'''
+  if args: frame = frame(*args)
+  stack = [frame]
+  value = error = None
+
+  while True:
+    try:
+      if error is None: frame = stack[-1].send(value)
+      else:
+        frame = stack[-1].throw(error)
+        error = None
+
+    except StopIteration as e:
+      stack.pop()
+      if not stack: return e.value
+      value = e.value
+      continue
+
+    except BaseException as e:
+      stack.pop()
+      if not stack: raise
+      error = e
+      continue
+
+    stack.append(frame)
+    value = None
+
+
+class TemplateArgs(collections.abc.Mapping):
+  '''The arguments of a template call by key.  An argument is expanded by
+  the frame ``expand(k, arg)`` when it is first referenced and its value is
+  cached, so arguments the template never refers to are never expanded.'''
+
+  def __init__(self, expand):
+    self.expand     = expand
+    self.unexpanded = {}
+    self.expanded   = {}
+
+
+  def __setitem__(self, k, arg):
+    self.unexpanded[k] = arg
+    self.expanded.pop(k, None)
+
+
+  def __getitem__(self, k):
+    v = self.expanded.get(k)
+    if v is None: v = _run(self.frame(k))
+    return v
+
+
+  def frame(self, k):
+    '''Returns a frame which evaluates to the value of the argument ``k``,
+    see ``_run()``.'''
+    v = self.expanded.get(k)
+    if v is None:
+      v = self.expanded[k] = yield self.expand(k, self.unexpanded[k])
+    return v
+
+
+  def get(self, k, default = None):
+    return self[k] if k in self.unexpanded else default
+
+
+  def __iter__(self): return iter(self.unexpanded)
+  def __len__(self): return len(self.unexpanded)
+  def __contains__(self, k): return k in self.unexpanded
+
+
+  def __repr__(self):
+    return repr({k: self.expanded.get(k, v)
+                 for k, v in self.unexpanded.items()})
+
+
 def expand(ctx, text, parent = None, timeout = None):
   '''Expands templates and parser functions and Lua macros from ``text``
   (which is from page with title ``title``).'''
@@ -59,118 +149,387 @@ def expand(ctx, text, parent = None, timeout = None):
     assert callable(expander)
     assert isinstance(parent, (tuple, type(None)))
 
+    # Lua code may not run past the time limit of the page
+    lua_timeout = timeout
+    limit = ctx.limits.get('expand_time')
+    if limit is not None:
+      left = ctx.start_time + limit - time.time()
+      if lua_timeout is None or left < lua_timeout: lua_timeout = left
+
     # Use the Lua sandbox to execute a Lua macro.  This will initialize
     # the Lua environment if it does not already exist (it needs to be
     # re-created for each page).
-    return call_lua_sandbox(ctx, invoke_args, expander, parent, timeout)
+    return call_lua_sandbox(ctx, invoke_args, expander, parent, lua_timeout)
 
 
-  def expand_recur(coded, parent):
-    '''This function does most of the work for expanding encoded
-    templates, arguments, and parser functions.'''
-    assert isinstance(coded, str)
-    assert isinstance(parent, (tuple, type(None)))
+  def limit_error(limit, args):
+    '''Returns the error markup of a call that exceeded a limit of the
+    page.'''
+    return ('<strong class=\'error\'>{} limit exceeded '
+            'while expanding template {}</strong>'
+            .format(limit, _unexpanded_template(args, True)))
 
-    def expand_args(coded, argmap):
-      assert isinstance(coded, str)
-      assert isinstance(argmap, dict)
-      parts = []
-      pos = 0
-      for m in re.finditer(r'[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST), coded):
-        new_pos = m.start()
-
-        if pos < new_pos: parts.append(coded[pos:new_pos])
-        pos = m.end()
-        ch  = m.group(0)
-        idx = ord(ch) - MAGIC_FIRST
-        kind, args, nowiki = ctx.load_cookie(idx)
-
-        assert isinstance(args, tuple)
-        if nowiki:
-          # If this template/link/arg has <nowiki />, then just
-          # keep it as-is (it won't be expanded)
-          parts.append(ch)
-          continue
-
-        if kind == 'T':
-          # Template transclusion or parser function call.
-          # Expand its arguments.
-          new_args = tuple([expand_args(x, argmap) for x in args])
-          parts.append(ctx.save_cookie(kind, new_args, nowiki))
-          continue
-
-        if kind == 'A':
-          # Template argument reference
-          if 2 < len(args):
-            ctx.debug('too many args ({}) in argument reference: {!r}'
-                      .format(len(args), args))
-          ctx.expand_stack.append('ARG-NAME')
-          k = expand_recur(expand_args(args[0], argmap), parent).strip()
-          ctx.expand_stack.pop()
 
-          if k.isdigit(): k = int(k)
-          else: k = re.sub(r'\s+', ' ', k).strip()
+  def expand_in(parent, coded):
+    '''Frame which expands ``coded`` in the frame ``parent``.'''
+    return expand_recur(coded, parent)
 
-          v = argmap.get(k, None)
-          if v is not None:
-            parts.append(v)
-            continue
 
-          if len(args) >= 2:
-            ctx.expand_stack.append('ARG-DEFVAL')
-            ret = expand_args(args[1], argmap)
-            ctx.expand_stack.pop()
-            parts.append(ret)
-            continue
+  def expand_parserfn(fn_name, args, parent):
+    '''Frame which expands a parser function call.  Functions made with
+    ``expanding()`` expand their arguments on the work stack, others are
+    passed an expander which runs its own work stack.'''
+    if fn_name in EXPENSIVE_FUNCTIONS:
+      ctx.expensive_calls += 1
+      limit = ctx.over_limit(True)
+      if limit:
+        name = fn_name + ':' + args[0] if args else fn_name
+        return limit_error(limit, (name,) + tuple(args[1:]))
 
-          # The argument is not defined (or name is empty)
-          arg = _unexpanded_arg([str(k)], nowiki)
-          parts.append(arg)
-          continue
+    profiler = ctx.profiler
+    if profiler: start = profiler.enter()
 
-        if kind == 'L':
-          # Link to another page
-          new_args = list(expand_args(x, argmap)
-                  for x in args)
-          parts.append(_unexpanded_link(new_args, nowiki))
-          continue
+    # Call parser function
+    if fn_name in PAGE_DEPENDENT_FUNCTIONS: ctx.page_dependent += 1
+    ctx.expand_stack.append(fn_name)
+    expander = functools.partial(_run, expand_in, parent)
 
-        if kind == 'E':
-          # Link to another page
-          new_args = [expand_args(x, argmap) for x in args]
-          parts.append(_unexpanded_extlink(new_args, nowiki))
-          continue
+    if fn_name == '#invoke': ret = invoke_fn(args, expander, parent)
+    else:
+      fn, args = parser_function(ctx, fn_name, args)
+      frame    = getattr(fn, 'frame', None)
+
+      if fn is None: ret = args
+      elif frame is None: ret = fn(ctx, fn_name, args, expander)
+      else:
+        frame = frame(ctx, fn_name, args)
+        value = None
+
+        while True:
+          try: arg = frame.send(value)
+          except StopIteration as e:
+            ret = e.value
+            break
+
+          if _cookie_re.search(arg): value = yield expand_recur(arg, parent)
+          else: value = arg
+
+    ctx.expand_stack.pop()  # fn_name
+    # XXX if lua code calls frame:preprocess(), then we should
+    # apparently encode and expand the return value, similarly to
+    # template bodies (without argument expansion)
+    # XXX current implementation of preprocess() does not match!!!
+    ret = str(ret)
+    ctx.include_size += len(ret)
+    if profiler: profiler.leave(fn_name, start, len(ret))
+
+    return ret
+
+
+  def expand_arg(k, arg, parent, stack, scope):
+    '''Frame which expands the template argument ``arg`` with the key ``k``
+    when it is first referenced, with the expansion stack and the cookie
+    scope of the call, ``stack`` and ``scope``.'''
+    if not _cookie_re.search(arg): return arg
+
+    # Expand arguments in the context of the frame where
+    # they are defined.  This makes a difference for
+    # calls to #invoke within a template argument (the
+    # parent frame would be different).
+    saved = ctx.expand_stack, ctx.cookie_scope
+    ctx.expand_stack = stack + [('ARGVAL-{}', k)]
+    ctx.cookie_scope = scope
+    try: return (yield expand_recur(arg, parent))
+    finally: ctx.expand_stack, ctx.cookie_scope = saved
+
+
+  def expand_plan(plan, argmap, parent, new_parent, out = None):
+    '''Frame which expands a compiled template body with the arguments
+    ``argmap``.  Arguments are substituted first, argument names with calls
+    are expanded in the ``parent`` frame.  Then calls in the body are
+    expanded in the frame of the template, ``new_parent``.  The output is
+    appended to the list ``out``, if given, otherwise it is returned.'''
+    table = {} # Cookies of the plan copied to the page
+
+    def substitute_args(node):
+      '''Substitutes arguments in the arguments of a node.'''
+      args = []
+      for arg in node[1]: args.append((yield from substitute(arg)))
+      return args
+
+
+    def substitute(nodes):
+      '''Substitutes arguments in a list of nodes, returns encoded text.'''
+      parts = []
 
-        if kind == 'N':
-          parts.append(ch)
-          continue
+      for node in nodes:
+        if node.__class__ is str: parts.append(node)
+        elif node[0] == 'A': parts.append((yield from argument(node)))
 
-        ctx.error('expand_arg: unsupported cookie kind {!r} in {}'
-                  .format(kind, m.group(0)))
-        parts.append(m.group(0))
+        elif node[0] == 'T':
+          args = yield from substitute_args(node)
+          parts.append(ctx.save_cookie('T', tuple(args), False))
+
+        elif node[0] == 'L':
+          args = yield from substitute_args(node)
+          parts.append(_unexpanded_link(args, False))
+
+        elif node[0] == 'E':
+          args = yield from substitute_args(node)
+          parts.append(_unexpanded_extlink(args, False))
 
-      parts.append(coded[pos:])
+        else: parts.append(plan.relocate(ctx, chr(MAGIC_FIRST + node[1]),
+                                         table))
 
       return ''.join(parts)
 
 
-    def expand_parserfn(fn_name, args):
-      # Call parser function
-      ctx.expand_stack.append(fn_name)
-      expander = lambda arg: expand_recur(arg, parent)
+    def argument(node):
+      '''Returns the value of a template argument reference.'''
+      kind, k, name, default, i = node
+
+      args = plan.cookies[i][1]
+      if 2 < len(args) and ctx.level <= DEBUG:
+        args = tuple(plan.relocate(ctx, arg, table) for arg in args)
+        ctx.debug('too many args ({}) in argument reference: {!r}'
+                  .format(len(args), args))
+
+      if k is None:
+        ctx.expand_stack.append('ARG-NAME')
+        k = yield from substitute(name)
+
+        # Names with calls are expanded in the frame of the caller
+        if _cookie_re.search(k): ctx.page_dependent += 1
+
+        k = arg_key((yield expand_recur(k, parent)))
+        ctx.expand_stack.pop()
+
+      if k in argmap: return (yield argmap.frame(k))
 
-      if fn_name == '#invoke': ret = invoke_fn(args, expander, parent)
-      else: ret = call_parser_function(ctx, fn_name, args, expander)
+      if default is not None:
+        ctx.expand_stack.append('ARG-DEFVAL')
+        ret = yield from substitute(default)
+        ctx.expand_stack.pop()
+        return ret
+
+      # The argument is not defined (or name is empty)
+      return _unexpanded_arg([str(k)], False)
+
+
+    for msg in plan.messages: ctx.debug(msg)
+
+    # Substitute all arguments before expanding any call
+    items = []
+    for node in plan.nodes:
+      if node.__class__ is str: items.append(node)
+      elif node[0] == 'T':
+        args = yield from substitute_args(node)
+        items.append((tuple(args), node[2]))
+      else: items.append((yield from substitute((node,))))
+
+    parts = [] if out is None else out
+    for item in items:
+      if item.__class__ is tuple:
+        yield expand_template(item[0], new_parent, parts, item[1])
+      elif not _cookie_re.search(item): parts.append(item)
+      elif ctx.rope: yield expand_recur(item, new_parent, parts)
+      else: parts.append((yield expand_recur(item, new_parent)))
+
+    if out is None: return ''.join(parts)
+
+
+  def expand_template(args, parent, out, split = None):
+    '''Frame which expands a template or parser function call with encoded
+    ``args`` and appends the output to the list ``out``.  ``split`` is the
+    result of ``plan._split()`` for each argument after the name, if
+    known.'''
+
+    # Limit recursion depth
+    if 100 <= len(ctx.expand_stack):
+      ctx.error('recursion too deep during template expansion')
+      out.append('<strong class=\'error\'>too deep recursion '
+                 'while expanding template {}</strong>'
+                 .format(_unexpanded_template(args, True)))
+      return
+
+    # Degrade to error markup once the page runs over its limits
+    ctx.template_calls += 1
+    limit = ctx.over_limit()
+    if limit:
+      out.append(limit_error(limit, args))
+      return
+
+    # Expand template/parserfn name
+    ctx.expand_stack.append('TEMPLATE_NAME')
+    tname = yield expand_recur(args[0], parent)
+    ctx.expand_stack.pop()
+
+    # Remove <noinclude/>
+    tname = re.sub(r'<\s*noinclude\s*/\s*>', '', tname)
+
+    # Strip safesubst: and subst: prefixes
+    tname = tname.strip()
+    if tname[:10].lower() == 'safesubst:': tname = tname[10:]
+    elif tname[:6].lower() == 'subst:': tname = tname[6:]
+
+    # Check if it is a parser function call
+    ofs = tname.find(':')
+    if 0 < ofs:
+      # It might be a parser function call
+      fn_name = ctx.name_data.canonicalize_parserfn_name(tname[:ofs])
+      if fn_name in PARSER_FUNCTIONS or fn_name.startswith('#'):
+        args = (tname[ofs + 1:].lstrip(),) + args[1:]
+        out.append((yield expand_parserfn(fn_name, args, parent)))
+        return
+
+    # As a compatibility feature, recognize parser functions
+    # also as the first argument of a template (without colon),
+    # whether there are more arguments or not.  This is used
+    # for magic words and some parser functions have an implicit
+    # compatibility template that essentially does this.
+    fn_name = ctx.name_data.canonicalize_parserfn_name(tname)
+    if fn_name in PARSER_FUNCTIONS or fn_name.startswith('#'):
+      out.append((yield expand_parserfn(fn_name, args[1:], parent)))
+      return
+
+    # Otherwise it must be a template expansion
+    body = ctx.get_template(tname)
+
+    # Check for undefined templates
+    if not body:
+      out.append('<strong class=\'error\'>Template:{}</strong>'
+                 .format(html.escape(tname)))
+      return
+
+    # If this template is not one of those we want to expand,
+    # return it unexpanded (but with arguments possibly expanded)
+    if not ctx.expand_template(tname):
+      # Note: we will still expand parser functions in its
+      # arguments, because those parser functions could
+      # refer to its parent frame and fail if expanded
+      # after eliminating the intermediate templates.
+      new_args = []
+      for x in args: new_args.append((yield expand_recur(x, parent)))
+      out.append(_unexpanded_template(new_args, False))
+      return
+
+    # Construct and expand template arguments
+    ctx.expand_stack.append(tname)
+    stack = ctx.expand_stack[:]
+    scope = ctx.cookie_scope
+    ht    = TemplateArgs(
+      lambda k, arg: expand_arg(k, arg, parent, stack, scope))
+    num   = 1
+
+    for i in range(1, len(args)):
+      arg   = str(args[i])
+      named = split[i - 1] if split else None
+
+      if named is None:
+        m = _named_arg_re.match(arg)
+        named = m.groups() if m else False
+
+      elif named: named = named[0], arg[named[1]:].strip()
+
+      if named:
+        # Note: Whitespace is stripped by the regexp
+        # around named parameter names and values per
+        # https://en.wikipedia.org/wiki/Help:Template
+        # (but not around unnamed parameters)
+        k, arg = named
+        if k.isdigit():
+          k = int(k)
+          if 1 < k or 1000 < k:
+            if ctx.level <= DEBUG:
+              ctx.debug('invalid argument number %d for template %r' % (
+                k, tname))
+            k = 1000
+          if num <= k: num = k + 1
 
-      ctx.expand_stack.pop()  # fn_name
-      # XXX if lua code calls frame:preprocess(), then we should
-      # apparently encode and expand the return value, similarly to
-      # template bodies (without argument expansion)
-      # XXX current implementation of preprocess() does not match!!!
-      return str(ret)
+        else:
+          ctx.expand_stack.append('ARGNAME')
+          k = yield expand_recur(k, parent)
+          k = re.sub(r'\s+', ' ', k).strip()
+          ctx.expand_stack.pop()
+
+      else:
+        k = num
+        num += 1
+
+      ht[k] = arg
+
+    # Spellings of the template name share its frame title, as in MediaWiki
+    new_title = re.sub(r'[\s_]+', ' ', tname).strip()
+    if ctx.name_data.get(new_title) is None:
+      new_title = ctx.name_data.get_name('Template') + ':' + new_title
+
+    # Spellings of the template name share its profile and memo entries
+    profiler = ctx.profiler
+    memo     = ctx.template_memo
+    if profiler or memo:
+      name = ctx.name_data.canonicalize_template_name(tname)
+
+    if profiler: start = profiler.enter()
+
+    # Reuse an earlier expansion with the same arguments
+    if memo:
+      # Expand the arguments read by memo.key() on the work stack
+      for k in ht:
+        if _cookie_re.search((yield ht.frame(k))): break
+
+    key  = memo.key(name, body, ht) if memo else None
+    t    = memo.get(key) if key else None
+    pos  = len(out) # Where the output starts
+
+    if t is not None:
+      out.append(t)
+      output = [t]
+
+    else:
+      mark = memo.mark() if key else None
+
+      # Expand the body
+      # Determine if the template starts with a list item
+      contains_list = re.match(r'(?s)^[#*;:]', body) is not None
+      if contains_list: body = '\n' + body
+
+      # Expand the compiled body using the calling template/page as
+      # the parent frame for any parserfn calls.  With ctx.rope the body
+      # is expanded straight into ``out``.  The cookies saved meanwhile
+      # are released unless the expansion refers to them.
+      new_parent = (new_title, ht)
+      plan  = ctx.template_plan(body)
+      outer = ctx.push_cookie_scope()
+
+      if ctx.rope: yield expand_plan(plan, ht, parent, new_parent, out)
+      else: out.append((yield expand_plan(plan, ht, parent, new_parent)))
+
+      output = out[pos:]
+      ctx.pop_cookie_scope(output, outer)
+
+      if key: memo.put(key, mark, ''.join(output))
+
+    ctx.expand_stack.pop()  # template name
+    size = sum(map(len, output))
+    if profiler: profiler.leave(name, start, size)
+
+    # Output past the include size limit is dropped
+    ctx.include_size += size
+    limit = ctx.over_limit()
+    if limit:
+      del out[pos:]
+      out.append(limit_error(limit, args))
+
+
+  def expand_recur(coded, parent, out = None):
+    '''Frame which does most of the work for expanding encoded templates,
+    arguments, and parser functions.  The output is appended to the list
+    ``out``, if given, otherwise it is returned.'''
+    assert isinstance(coded, str)
+    assert isinstance(parent, (tuple, type(None)))
 
     # Main code of expand_recur()
-    parts = []
+    parts = [] if out is None else out
     pos = 0
     for m in re.finditer(r'[{:c}-{:c}]'.format(MAGIC_FIRST, MAGIC_LAST), coded):
       new_pos = m.start()
@@ -188,140 +547,9 @@ def expand(ctx, text, parent = None, timeout = None):
       assert isinstance(args, tuple)
 
       if kind == 'T':
-        if nowiki:
-          parts.append(_unexpanded_template(args, nowiki))
-          continue
-
         # Template transclusion or parser function call
-        # Limit recursion depth
-        if 100 <= len(ctx.expand_stack):
-          ctx.error('recursion too deep during template expansion')
-          parts.append('<strong class=\'error\'>too deep recursion '
-                       'while expanding template {}</strong>'
-                       .format(_unexpanded_template(args, True)))
-          continue
-
-        # Expand template/parserfn name
-        ctx.expand_stack.append('TEMPLATE_NAME')
-        tname = expand_recur(args[0], parent)
-        ctx.expand_stack.pop()
-
-        # Remove <noinclude/>
-        tname = re.sub(r'<\s*noinclude\s*/\s*>', '', tname)
-
-        # Strip safesubst: and subst: prefixes
-        tname = tname.strip()
-        if tname[:10].lower() == 'safesubst:': tname = tname[10:]
-        elif tname[:6].lower() == 'subst:': tname = tname[6:]
-
-        # Check if it is a parser function call
-        ofs = tname.find(':')
-        if 0 < ofs:
-          # It might be a parser function call
-          fn_name = ctx.name_data.canonicalize_parserfn_name(tname[:ofs])
-          if fn_name in PARSER_FUNCTIONS or fn_name.startswith('#'):
-            args = (tname[ofs + 1:].lstrip(),) + args[1:]
-            parts.append(expand_parserfn(fn_name, args))
-            continue
-
-        # As a compatibility feature, recognize parser functions
-        # also as the first argument of a template (without colon),
-        # whether there are more arguments or not.  This is used
-        # for magic words and some parser functions have an implicit
-        # compatibility template that essentially does this.
-        fn_name = ctx.name_data.canonicalize_parserfn_name(tname)
-        if fn_name in PARSER_FUNCTIONS or fn_name.startswith('#'):
-          parts.append(expand_parserfn(fn_name, args[1:]))
-          continue
-
-        # Otherwise it must be a template expansion
-        body = ctx.get_template(tname)
-
-        # Check for undefined templates
-        if not body:
-          parts.append('<strong class=\'error\'>Template:{}</strong>'
-                       .format(html.escape(tname)))
-          continue
-
-        # If this template is not one of those we want to expand,
-        # return it unexpanded (but with arguments possibly expanded)
-        if not ctx.expand_template(tname):
-          # Note: we will still expand parser functions in its
-          # arguments, because those parser functions could
-          # refer to its parent frame and fail if expanded
-          # after eliminating the intermediate templates.
-          new_args = [expand_recur(x, parent) for x in args]
-          parts.append(_unexpanded_template(new_args, nowiki))
-          continue
-
-        # Construct and expand template arguments
-        ctx.expand_stack.append(tname)
-        ht = {}
-        num = 1
-
-        for i in range(1, len(args)):
-          arg = str(args[i])
-          m = re.match(r'(?s)^\s*([^][&<>="\']+?)\s*=\s*(.*?)\s*$', arg)
-          if m:
-            # Note: Whitespace is stripped by the regexp
-            # around named parameter names and values per
-            # https://en.wikipedia.org/wiki/Help:Template
-            # (but not around unnamed parameters)
-            k, arg = m.groups()
-            if k.isdigit():
-              k = int(k)
-              if 1 < k or 1000 < k:
-                ctx.debug('invalid argument number %d for template %r' % (
-                  k, tname))
-                k = 1000
-              if num <= k: num = k + 1
-
-            else:
-              ctx.expand_stack.append('ARGNAME')
-              k = expand_recur(k, parent)
-              k = re.sub(r'\s+', ' ', k).strip()
-              ctx.expand_stack.pop()
-
-          else:
-            k = num
-            num += 1
-
-          # Expand arguments in the context of the frame where
-          # they are defined.  This makes a difference for
-          # calls to #invoke within a template argument (the
-          # parent frame would be different).
-          ctx.expand_stack.append('ARGVAL-{}'.format(k))
-          arg = expand_recur(arg, parent)
-          ctx.expand_stack.pop()
-          ht[k] = arg
-
-        # Expand the body
-        # XXX optimize by pre-encoding bodies during preprocessing
-        # (Each template is typically used many times)
-        # Determine if the template starts with a list item
-        contains_list = re.match(r'(?s)^[#*;:]', body) is not None
-        if contains_list: body = '\n' + body
-        encoded_body = encode(ctx, body)
-
-        # Expand template arguments recursively.  The arguments
-        # are already expanded.
-        encoded_body = expand_args(encoded_body, ht)
-
-        # Expand the body using the calling template/page as
-        # the parent frame for any parserfn calls
-        new_title = tname.strip()
-        if ctx.name_data.get(new_title) is None:
-          new_title = ctx.name_data.get_name('Template') + ':' + new_title
-
-        new_parent = (new_title, ht)
-        # XXX no real need to expand here, it will expanded on
-        # next iteration anyway (assuming parent unchanged)
-        # Otherwise expand the body
-        t = expand_recur(encoded_body, new_parent)
-
-        assert isinstance(t, str)
-        ctx.expand_stack.pop()  # template name
-        parts.append(t)
+        if nowiki: parts.append(_unexpanded_template(args, nowiki))
+        else: yield expand_template(args, parent, parts)
 
       elif kind == 'A': parts.append(_unexpanded_arg(args, nowiki))
 
@@ -330,7 +558,8 @@ def expand(ctx, text, parent = None, timeout = None):
         else:
           # Link to another page
           ctx.expand_stack.append('[[link]]')
-          new_args = [expand_recur(x, parent) for x in args]
+          new_args = []
+          for x in args: new_args.append((yield expand_recur(x, parent)))
           ctx.expand_stack.pop()
           parts.append(_unexpanded_link(new_args, nowiki))
 
@@ -339,7 +568,8 @@ def expand(ctx, text, parent = None, timeout = None):
         else:
           # Link to an external page
           ctx.expand_stack.append('[extlink]')
-          new_args = [expand_recur(x, parent) for x in args]
+          new_args = []
+          for x in args: new_args.append((yield expand_recur(x, parent)))
           ctx.expand_stack.pop()
           parts.append(_unexpanded_extlink(new_args, nowiki))
 
@@ -352,14 +582,14 @@ def expand(ctx, text, parent = None, timeout = None):
 
     parts.append(coded[pos:])
 
-    return ''.join(parts)
+    if out is None: return ''.join(parts)
 
   # Encode all template calls, template arguments, and parser function
   # calls on the page.  This is an inside-out operation.
   encoded = encode(ctx, text)
 
-  # Recursively expand templates.  This is an outside-in operation.
-  expanded = expand_recur(encoded, parent)
+  # Expand templates on a work stack.  This is an outside-in operation.
+  expanded = _run(expand_recur(encoded, parent))
 
   # Expand any remaining magic cookies and remove nowiki char
   expanded = finalize_expand(ctx, expanded)
@@ -372,34 +602,53 @@ def expand(ctx, text, parent = None, timeout = None):
 
 def finalize_expand(ctx, text):
   '''Expands any remaining magic characters (to their original values)
-  and removes nowiki characters.'''
+  and converts nowiki characters back to <nowiki />, in one pass.  The
+  cookies in the arguments of a cookie are restored depth-first into the
+  same output.'''
+  if not _magic_re.search(text): return text
 
-  def magic_repl(m):
-    idx = ord(m.group(0)) - MAGIC_FIRST
-    if not ctx.has_cookie(idx): return m.group(0)
-    kind, args, nowiki = ctx.load_cookie(idx)
+  parts = []
+  stack = [(text, 0)] # Text left to restore and where it starts
 
-    if kind == 'T': return _unexpanded_template(args, nowiki)
-    if kind == 'A': return _unexpanded_arg(args, nowiki)
-    if kind == 'L': return _unexpanded_link(args, nowiki)
-    if kind == 'E': return _unexpanded_extlink(args, nowiki)
-    if kind == 'N': return '<nowiki>' + args[0] + '</nowiki>'
+  while stack:
+    text, pos = stack.pop()
 
-    ctx.error('magic_repl: unsupported cookie kind {!r}'.format(kind))
-    return ''
+    for m in _magic_re.finditer(text, pos):
+      parts.append(text[pos:m.start()])
+      pos = m.end()
+      ch  = m.group(0)
 
-  # Keep expanding magic cookies until they have all been expanded.
-  # We might get them from, e.g., unexpanded_template()
-  while True:
-    prev = text
-    text = re.sub(
-      r'[{:c}-{:c}]'.format(MAGIC_FIRST, MAGIC_LAST), magic_repl, text)
+      if ch == MAGIC_NOWIKI_CHAR:
+        parts.append('<nowiki />')
+        continue
+
+      idx = ord(ch) - MAGIC_FIRST
+      if not ctx.has_cookie(idx):
+        parts.append(ch)
+        continue
+
+      # Restore the cookie, its arguments may have cookies, then the rest
+      stack.append((text, pos))
+      stack.append((_restore_cookie(ctx, idx), 0))
+      break
+
+    else: parts.append(text[pos:])
+
+  return ''.join(parts)
+
+
+def _restore_cookie(ctx, idx):
+  '''Returns the original text of a cookie, which may contain cookies.'''
+  kind, args, nowiki = ctx.load_cookie(idx)
 
-    if prev == text: break
+  if kind == 'T': return _unexpanded_template(args, nowiki)
+  if kind == 'A': return _unexpanded_arg(args, nowiki)
+  if kind == 'L': return _unexpanded_link(args, nowiki)
+  if kind == 'E': return _unexpanded_extlink(args, nowiki)
+  if kind == 'N': return '<nowiki>' + args[0] + '</nowiki>'
 
-  # Convert the special <nowiki /> character back to <nowiki />.
-  # This is done at the end of normal expansion.
-  return re.sub(MAGIC_NOWIKI_CHAR, '<nowiki />', text)
+  ctx.error('finalize_expand: unsupported cookie kind {!r}'.format(kind))
+  return ''
 
 
 def preprocess_text(ctx, text):
@@ -27,6 +27,27 @@ mw_python_fetch_language_names = nil
 _mw_frame = "<unassigned>"
 _mw_pageTitle = "<unassigned>"
 
+-- Set when the current call reads the page title or the current time, so
+-- that its result is not reused for other pages.
+local page_dependent = false
+
+function mw_page_dependent()
+   page_dependent = true
+end
+
+local _orig_os_date = os.date
+local _orig_os_time = os.time
+
+os.date = function(format, time)
+   if time == nil then mw_page_dependent() end
+   return _orig_os_date(format, time)
+end
+
+os.time = function(t)
+   if t == nil then mw_page_dependent() end
+   return _orig_os_time(t)
+end
+
 local function frame_args_index(new_args, key)
    local i = tonumber(key)
    if i ~= nil then
@@ -36,6 +57,8 @@ local function frame_args_index(new_args, key)
    if v == nil then return nil end
    if not new_args._preprocessed[key] then
       local frame = new_args._frame
+      -- Arguments of the parent frame are expanded when first read
+      if new_args._get ~= nil then v = new_args._get(key) end
       v = frame:preprocess(v)
       -- Cache preprocessed value so we only preprocess each argument once
       new_args._preprocessed[key] = true
@@ -96,7 +119,8 @@ local function prepare_frame_args(frame)
      prev = k
   end
   new_args = {_orig = frame.args, _frame = frame, _next_key = next_key,
-              _preprocessed = {}}
+              _preprocessed = {}, _get = frame._get_arg}
+  frame._get_arg = nil
   setmetatable(new_args, frame_args_meta)
   frame.args = new_args
   frame.argumentPairs = function (frame) return pairs(frame.args) end
@@ -200,6 +224,20 @@ local function _lua_invoke(mod_name, fn_name, frame, page_title, timeout)
    return st, v
 end
 
+-- Calls _lua_invoke() and also returns whether the call depended on the
+-- page being expanded.  Nested calls mark the calls they are nested in.
+local function _lua_invoke_tracked(mod_name, fn_name, frame, page_title,
+                                   timeout)
+   local saved = page_dependent
+   page_dependent = false
+   local ok, st, v = pcall(_lua_invoke, mod_name, fn_name, frame, page_title,
+                           timeout)
+   local dependent = page_dependent
+   page_dependent = saved or dependent
+   if not ok then error(st, 0) end
+   return st, v, dependent
+end
+
 -- This should be called immediately after loading the sandbox to set the
 -- Python function that will be used for loading Lua modules and various
 -- other Python functions that implement some of the functionality needed
@@ -341,4 +379,4 @@ end
 assert(io == nil)
 assert(_G.io == nil)
 
-return { _lua_set_functions, _lua_invoke, _lua_reset_env }
+return { _lua_set_functions, _lua_invoke_tracked, _lua_reset_env }
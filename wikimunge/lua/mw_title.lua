@@ -284,6 +284,7 @@ function mw_title.new(text, namespace)
 end
 
 function mw_title.getCurrentTitle()
+   mw_page_dependent()
    local t = mw_title.new(_mw_pageTitle)
    if t == nil then
       print("mw.title.getCurrentTitle returns nil")
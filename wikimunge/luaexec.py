@@ -388,18 +388,24 @@ def call_lua_sandbox(ctx, invoke_args, expander, parent, timeout):
 
     return lua.table_from({'expand': lambda obj: frame[fexpander](x)})
 
-  def make_frame(pframe, title, args):
+  def clean_arg(arg):
+    # Remove any <noinclude/> tags; they are used to prevent
+    # certain token interpretations in Wiktionary
+    # (e.g., Template:cop-fay-conj-table), whereas Lua code
+    # does not always like them (e.g., remove_links() in
+    # Module:links).
+    arg = re.sub(r'(?si)<\s*noinclude\s*/\s*>', '', arg)
+    return html.unescape(arg)
+
+  def make_frame(pframe, title, args, get_arg = None):
     assert isinstance(title, str)
     assert isinstance(args, (list, tuple, dict))
 
     # Convert args to a dictionary with default value None
-    if isinstance(args, dict):
-      frame_args = {}
-
-      for k, arg in args.items():
-        arg = re.sub(r'(?si)<\s*noinclude\s*/\s*>', '', arg)
-        arg = html.unescape(arg)
-        frame_args[k] = arg
+    if get_arg is not None:
+      # The arguments are only read with get_arg() when Lua code first
+      # refers to them, see prepare_frame_args() in _sandbox_phase2.lua
+      frame_args = dict.fromkeys(args, True)
 
     else:
       assert isinstance(args, (list, tuple))
@@ -422,14 +428,7 @@ def call_lua_sandbox(ctx, invoke_args, expander, parent, timeout):
           k = num
           num += 1
 
-        # Remove any <noinclude/> tags; they are used to prevent
-        # certain token interpretations in Wiktionary
-        # (e.g., Template:cop-fay-conj-table), whereas Lua code
-        # does not always like them (e.g., remove_links() in
-        # Module:links).
-        arg = re.sub(r'(?si)<\s*noinclude\s*/\s*>', '', arg)
-        arg = html.unescape(arg)
-        frame_args[k] = arg
+        frame_args[k] = clean_arg(arg)
 
     frame_args = lua.table_from(frame_args)
 
@@ -556,6 +555,7 @@ def call_lua_sandbox(ctx, invoke_args, expander, parent, timeout):
     # Create frame object as dictionary with default value None
     frame = {}
     frame['args'] = frame_args
+    if get_arg is not None: frame['_get_arg'] = lambda k: clean_arg(get_arg(k))
 
     # argumentPairs is set in sandbox.lua
     frame['callParserFunction'] = callParserFunction
@@ -581,13 +581,15 @@ def call_lua_sandbox(ctx, invoke_args, expander, parent, timeout):
   # (for module being called)
   if parent is not None:
     parent_title, page_args = parent
-    expanded_key_args = {}
+    expanded_keys = {}
 
-    for k, v in page_args.items():
-      if isinstance(k, str): expanded_key_args[expander(k)] = v
-      else: expanded_key_args[k] = v
+    for k in page_args:
+      if isinstance(k, str): expanded_keys[expander(k)] = k
+      else: expanded_keys[k] = k
 
-    pframe = make_frame(None, parent_title, expanded_key_args)
+    # The arguments of the page are expanded when they are first read
+    pframe = make_frame(None, parent_title, expanded_keys,
+                        lambda k: page_args[expanded_keys[k]])
 
   else: pframe = None
 
@@ -595,13 +597,17 @@ def call_lua_sandbox(ctx, invoke_args, expander, parent, timeout):
 
   # Call the Lua function in the given module
   stack_len = len(ctx.expand_stack)
-  ctx.expand_stack.append('Lua:{}:{}()'.format(modname, modfn))
+  ctx.expand_stack.append(('Lua:{}:{}()', modname, modfn))
   try:
     ret = ctx.lua_invoke(modname, modfn, frame, ctx.title, timeout)
     if not isinstance(ret, (list, tuple)): ok, text = ret, ''
     elif len(ret) == 1: ok, text = ret[0], ''
     else: ok, text = ret[0], ret[1]
 
+    # Read the page title or the current time
+    if isinstance(ret, (list, tuple)) and 2 < len(ret) and ret[2]:
+      ctx.page_dependent += 1
+
   except UnicodeDecodeError:
     ctx.debug('invalid unicode returned from lua by %s: parent %s' % (
       invoke_args, parent))
@@ -1,26 +1,43 @@
-import bz2
 import xml.sax
 
+from .dumpfile import open_dump
+
+
+def keep_page(page, page_filter):
+  '''Returns True if ``page_filter`` accepts the partially read page.  The
+  filter is called once per page with ``(model, ns, title)`` before its
+  <text> is read.'''
+  if page_filter is None: return True
+
+  keep = page.get('keep')
+
+  if keep is None:
+    model = 'redirect' if 'redirect' in page else page.get('model')
+    keep = page['keep'] = bool(page_filter(model, page['ns'], page['title']))
+
+  return keep
+
 
 class MediaWikiSAX(xml.sax.ContentHandler):
-  def __init__(self):
+  def __init__(self, namespaces = None, page_filter = None):
     self.depth = 0
     self.content = None
     self.page = None
     self.inNS = False
-    self.namespaces = {}
+    self.namespaces = {} if namespaces is None else namespaces
+    self.page_filter = page_filter
 
 
   def parse(self, path, handler):
+    with open_dump(path) as f: self.parse_file(f, handler)
+
+
+  def parse_file(self, f, handler):
     self.handler = handler
 
     parser = xml.sax.make_parser()
     parser.setContentHandler(self)
-
-    def _open(path):
-      return bz2.open(path) if path.endswith('.bz2') else open(path, 'r')
-
-    with _open(path) as f: parser.parse(f)
+    parser.parse(f)
 
 
   def expect_tag(self, name, expected):
@@ -53,7 +70,11 @@ class MediaWikiSAX(xml.sax.ContentHandler):
         if name == 'redirect':
           self.page['redirect'] = attrs['title']
 
-        if name in ('ns', 'title', 'model', 'text'):
+        if name in ('ns', 'title', 'model'): self.capture_content()
+
+        # Redirect text is not used and filtered pages are dropped
+        if name == 'text' and 'redirect' not in self.page and \
+           keep_page(self.page, self.page_filter):
           self.capture_content()
 
     self.depth += 1
@@ -75,15 +96,17 @@ class MediaWikiSAX(xml.sax.ContentHandler):
 
         else: model = self.page['model']
 
-        self.handler(model, self.page['ns'], self.page['title'],
-                     self.page.get('text', []))
+        if keep_page(self.page, self.page_filter):
+          self.handler(model, self.page['ns'], self.page['title'],
+                       self.page.get('text', []))
 
         self.page = None
 
       if name == 'ns':    self.page['ns'] = self.namespaces[self.get_content()]
       if name == 'title': self.page['title']  = self.get_content()
       if name == 'model': self.page['model']  = self.get_content()
-      if name == 'text':  self.page['text']   = self.content
+      if name == 'text' and self.content is not None:
+        self.page['text'] = self.content
 
     self.content = None
 
@@ -0,0 +1,107 @@
+import re
+import collections
+
+from .common import MAGIC_FIRST, MAGIC_LAST
+
+
+_cookie_re = re.compile('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST))
+
+
+class TemplateMemo:
+  '''An LRU memo of template expansions keyed by the canonical template
+  name, its body and its expanded arguments.  ``size`` bounds the total
+  length of the memoized expansions and arguments in characters.
+
+  An expansion is not memoized if it, or any expansion nested in it, read
+  the page title, the current time or the frame of its caller, see
+  ``Context.page_dependent``, or logged a message.  Neither are expansions
+  whose arguments or value refer to the magic cookies of the page.'''
+
+  def __init__(self, ctx, size):
+    self.ctx       = ctx
+    self.size      = size
+    self.used      = 0
+    self.memo      = collections.OrderedDict()
+    self.hits      = 0
+    self.misses    = 0
+    self.impure    = 0
+    self.evictions = 0
+
+
+  def key(self, name, body, args):
+    '''Returns the memo key of a template expansion or None if it cannot be
+    memoized.  This expands all the arguments of the call.'''
+    for v in args.values():
+      if _cookie_re.search(v): return None
+
+    return name, body, frozenset(args.items())
+
+
+  def get(self, key):
+    '''Returns a memoized expansion or None.'''
+    if key in self.memo:
+      self.hits += 1
+      self.memo.move_to_end(key)
+      return self.memo[key][0]
+
+    self.misses += 1
+
+
+  def mark(self):
+    '''Returns the state checked by ``put()``, call before expanding.'''
+    return self.ctx.page_dependent, self.ctx.message_count
+
+
+  def put(self, key, mark, text):
+    if mark != self.mark() or _cookie_re.search(text):
+      self.impure += 1
+      return
+
+    size = len(text) + sum(len(str(k)) + len(v) for k, v in key[2])
+    if self.size < size: return
+
+    self.memo[key] = text, size
+    self.used += size
+
+    while self.size < self.used:
+      text, size = self.memo.popitem(last = False)[1]
+      self.used -= size
+      self.evictions += 1
+
+
+  def take_counts(self):
+    '''Returns the hits, misses, impure expansions and evictions counted
+    since the last call and starts counting from zero.'''
+    counts = self.hits, self.misses, self.impure, self.evictions
+    self.hits = self.misses = self.impure = self.evictions = 0
+    return counts
+
+
+  def merge(self, counts):
+    '''Adds the ``counts`` of another memo, e.g. from a worker.'''
+    hits, misses, impure, evictions = counts
+    self.hits      += hits
+    self.misses    += misses
+    self.impure    += impure
+    self.evictions += evictions
+
+
+  def stats(self):
+    '''Returns the counts, including those merged from other memos, and the
+    entries and characters used in the memo of this process.'''
+    lookups = self.hits + self.misses
+
+    return dict(
+      hits      = self.hits,
+      misses    = self.misses,
+      impure    = self.impure,
+      evictions = self.evictions,
+      entries   = len(self.memo),
+      used      = self.used,
+      hit_rate  = self.hits / lookups if lookups else 0)
+
+
+  def __str__(self):
+    return ('template memo: {hits:,} hits {misses:,} misses ({hit_rate:.1%}) '
+            '{impure:,} impure {evictions:,} evictions {entries:,} entries '
+            '{used:,} chars'.format(**self.stats()))
@@ -0,0 +1,119 @@
+import io
+import bz2
+import collections
+import multiprocessing
+
+from .mediawikiexpat import MediaWikiExpat
+
+
+# Set before the pool forks so that workers inherit it without pickling
+_page_filter = None
+
+
+def read_multistream_index(path):
+  '''Returns the sorted list of unique stream offsets in a multistream
+  index file.  Each line of the index has the form ``offset:id:title``.'''
+  offsets = set()
+
+  with bz2.open(path, 'rt', encoding = 'utf-8') as f:
+    for line in f:
+      offset = line.split(':', 1)[0]
+      if offset: offsets.add(int(offset))
+
+  return sorted(offsets)
+
+
+def _read_stream(path, start, end):
+  with open(path, 'rb') as f:
+    f.seek(start)
+    return bz2.decompress(f.read(-1 if end is None else end - start))
+
+
+def read_stream_pages(path, start, end, namespaces, page_filter = None):
+  '''Decompresses and parses one bz2 stream of <page> elements and returns
+  the pages found as ``(info, page)`` pairs.'''
+  data = _read_stream(path, start, end).strip()
+
+  # The last stream also contains the closing tag
+  if data.endswith(b'</mediawiki>'): data = data[:-12]
+
+  data   = io.BytesIO(b'<mediawiki>' + data + b'</mediawiki>')
+  reader = MediaWikiExpat(namespaces, page_filter)
+  pages  = []
+
+  for model, ns, title, text in reader.read_file(data):
+    pages.append((reader.info, (model, ns, title, [''.join(text)])))
+
+  return pages
+
+
+def _parse_stream(args):
+  # Runs in a pool worker
+  return read_stream_pages(*args, _page_filter)
+
+
+class MediaWikiMultiStream:
+  '''Reads a ``pages-articles-multistream.xml.bz2`` dump using its
+  ``-index.txt.bz2`` file.  The independent bz2 streams are decompressed
+  and parsed in a process pool and the pages are passed, in dump order, to
+  the handler in the calling process.
+
+  ``position`` is ``(stream, count)``, the number of the current stream and
+  of its pages already returned.  Reading can be resumed there.  ``info`` is
+  the revision metadata of the last page returned.'''
+
+  def __init__(self, index, threads = None, page_filter = None):
+    self.index       = index
+    self.threads     = threads or multiprocessing.cpu_count()
+    self.page_filter = page_filter
+    self.namespaces  = {}
+    self.position    = (0, 0)
+    self.info        = None
+
+
+  def parse_header(self, path, end):
+    # The first stream holds <siteinfo> but not the closing </mediawiki>
+    data = _read_stream(path, 0, end) + b'</mediawiki>'
+
+    reader = MediaWikiExpat()
+    for page in reader.read_file(io.BytesIO(data)): pass
+    self.namespaces = reader.namespaces
+
+
+  def parse(self, path, handler, position = None):
+    global _page_filter
+
+    offsets = read_multistream_index(self.index)
+    if not offsets: raise Exception('Empty multistream index %s' % self.index)
+
+    self.parse_header(path, offsets[0])
+
+    ends  = offsets[1:] + [None]
+    tasks = [(path, start, end, self.namespaces)
+             for start, end in zip(offsets, ends)]
+
+    # Keep a bounded window of streams in flight so that decompressed pages
+    # do not pile up in memory when the handler is slower than the pool
+    window  = 4 * self.threads
+    pending = collections.deque()
+    first, skip = position or (0, 0)
+
+    def handle_stream():
+      stream, result = pending.popleft()
+      pages = result.get()
+
+      for i in range(skip if stream == first else 0, len(pages)):
+        self.position = (stream, i + 1)
+        self.info, page = pages[i]
+        handler(*page)
+
+    _page_filter = self.page_filter
+
+    with multiprocessing.Pool(self.threads) as pool:
+      for stream in range(first, len(tasks)):
+        result = pool.apply_async(_parse_stream, (tasks[stream],))
+        pending.append((stream, result))
+
+        if window <= len(pending): handle_stream()
+
+      while pending: handle_stream()
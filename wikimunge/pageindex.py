@@ -0,0 +1,229 @@
+import os
+import json
+import mmap
+import array
+import struct
+import collections.abc
+
+
+# An immutable on-disk index of sorted tables which is memory mapped and
+# queried in place.  The file is laid out as:
+#
+#   MAGIC, header offset (u64), sections..., JSON header
+#
+# Each table has a key offset array (count + 1 native u64), a blob of UTF-8
+# keys in code point order, fixed-width records and, for string tables, a
+# blob of UTF-8 values.  Records of string tables are (offset, size) into the
+# values blob.  Arrays are stored as native u64.
+MAGIC = b'WMINDEX1'
+
+_header = struct.Struct('<Q')
+_string = struct.Struct('<QQ')
+
+
+def _align(f):
+  pad = -f.tell() % 8
+  if pad: f.write(b'\0' * pad)
+  return f.tell()
+
+
+class MappedTable(collections.abc.Mapping):
+  '''A read-only mapping over one table of a memory mapped index.  Values
+  are passed through ``decode`` if given and kept in memory if ``memo`` is
+  True.'''
+
+  def __init__(self, mm, meta, decode = None, memo = False):
+    self.mm      = mm
+    self.count   = meta['count']
+    self.keys_at = meta['keys']
+    self.blob    = meta['blob']
+    self.records = meta['records']
+    self.values  = meta.get('values')
+    self.struct  = struct.Struct(meta['format'])
+    self.decode  = decode
+    self.memo    = {} if memo else None
+
+    size = 8 * (self.count + 1)
+    self.koffs = memoryview(mm)[self.keys_at : self.keys_at + size].cast('Q')
+
+
+  def key(self, i):
+    blob = self.blob
+    return self.mm[blob + self.koffs[i] : blob + self.koffs[i + 1]]
+
+
+  def find(self, key):
+    '''Returns the position of ``key`` in the table or -1.'''
+    key   = key.encode('utf-8')
+    lo    = 0
+    hi    = self.count
+    koffs = self.koffs
+    blob  = self.blob
+    mm    = self.mm
+
+    while lo < hi:
+      mid   = (lo + hi) >> 1
+      probe = mm[blob + koffs[mid] : blob + koffs[mid + 1]]
+
+      if probe < key: lo = mid + 1
+      elif key < probe: hi = mid
+      else: return mid
+
+    return -1
+
+
+  def value(self, i):
+    record = self.struct.unpack_from(self.mm, self.records + i * self.struct.size)
+
+    if self.values is not None:
+      offset, size = record
+      start  = self.values + offset
+      record = self.mm[start : start + size].decode('utf-8')
+
+    return record if self.decode is None else self.decode(record)
+
+
+  def __getitem__(self, key):
+    if self.memo is not None and key in self.memo: return self.memo[key]
+
+    i = self.find(key)
+    if i == -1: raise KeyError(key)
+
+    value = self.value(i)
+    if self.memo is not None: self.memo[key] = value
+
+    return value
+
+
+  def __contains__(self, key): return self.find(key) != -1
+  def __len__(self): return self.count
+
+
+  def __iter__(self):
+    for i in range(self.count): yield self.key(i).decode('utf-8')
+
+
+class OverlayDict(collections.abc.MutableMapping):
+  '''A mutable mapping which records changes to a read-only base mapping in
+  memory.'''
+
+  def __init__(self, base):
+    self.base    = base
+    self.added   = {}
+    self.removed = set()
+
+
+  def __getitem__(self, key):
+    if key in self.added: return self.added[key]
+    if key in self.removed: raise KeyError(key)
+    return self.base[key]
+
+
+  def __contains__(self, key):
+    if key in self.added: return True
+    return key not in self.removed and key in self.base
+
+
+  def __setitem__(self, key, value):
+    self.added[key] = value
+    self.removed.discard(key)
+
+
+  def __delitem__(self, key):
+    if key not in self: raise KeyError(key)
+    self.added.pop(key, None)
+    if key in self.base: self.removed.add(key)
+
+
+  def __iter__(self):
+    yield from self.added
+
+    for key in self.base:
+      if key not in self.added and key not in self.removed: yield key
+
+
+  def __len__(self): return sum(1 for key in self)
+
+
+def _write_table(f, items, fmt = None, encode = None):
+  '''Writes a table of ``(key, value)`` pairs sorted by key.  Without
+  ``fmt`` values are strings.'''
+  items = sorted(items)
+  keys  = [key.encode('utf-8') for key, value in items]
+  meta  = dict(count = len(items), format = fmt or _string.format)
+
+  koffs = array.array('Q', [0])
+  for key in keys: koffs.append(koffs[-1] + len(key))
+
+  meta['keys'] = _align(f)
+  f.write(koffs.tobytes())
+
+  meta['blob'] = f.tell()
+  for key in keys: f.write(key)
+
+  if fmt is None:
+    values = [value.encode('utf-8') for key, value in items]
+    meta['records'] = _align(f)
+    offset = 0
+
+    for value in values:
+      f.write(_string.pack(offset, len(value)))
+      offset += len(value)
+
+    meta['values'] = f.tell()
+    for value in values: f.write(value)
+
+  else:
+    meta['records'] = _align(f)
+    record = struct.Struct(fmt)
+    for key, value in items: f.write(record.pack(*encode(value)))
+
+  return meta
+
+
+def write_index(path, tables, info = None, arrays = None):
+  '''Atomically writes an index file.  ``tables`` maps table names to
+  ``(items, fmt, encode)`` where ``fmt`` and ``encode`` are None for string
+  tables.  ``arrays`` maps names to sequences of integers.  ``info`` is
+  extra JSON data stored in the header.'''
+  header = dict(info = info, tables = {}, arrays = {})
+
+  with open(path + '.tmp', 'wb') as f:
+    f.write(MAGIC + _header.pack(0))
+
+    for name, (items, fmt, encode) in tables.items():
+      header['tables'][name] = _write_table(f, items, fmt, encode)
+
+    for name, values in (arrays or {}).items():
+      values = array.array('Q', values)
+      header['arrays'][name] = dict(offset = _align(f), count = len(values))
+      f.write(values.tobytes())
+
+    # Header at the end, its offset is stored after the magic
+    start = _align(f)
+    f.write(json.dumps(header).encode('utf-8'))
+    f.seek(len(MAGIC))
+    f.write(_header.pack(start))
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.replace(path + '.tmp', path)
+
+
+def open_index(path):
+  '''Maps an index file and returns ``(mm, header)``.'''
+  with open(path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+  if mm[:len(MAGIC)] != MAGIC: raise Exception('Invalid index file %s' % path)
+
+  start, = _header.unpack_from(mm, len(MAGIC))
+  header = json.loads(mm[start:].decode('utf-8'))
+
+  return mm, header
+
+
+def map_array(mm, meta):
+  '''Returns a read-only view of an array of an index file.'''
+  start = meta['offset']
+  return memoryview(mm)[start : start + 8 * meta['count']].cast('Q')
@@ -517,9 +517,38 @@ def url_fn(ctx, token):
   if suffix: text_fn(ctx, suffix)
 
 
+def _parser_close(ctx, kinds):
+  '''Pops nodes until a node of one of ``kinds`` has been popped or only
+  the root node is left.'''
+  while True:
+    node = ctx.parser_stack[-1]
+    if node.kind == NodeKind.ROOT: break
+    if node.kind in kinds:
+      _parser_pop(ctx, False)
+      break
+
+    _parser_pop(ctx, True)
+
+
+def _cookie_work(ctx, args, close):
+  '''Returns the work items which process the arguments of a magic
+  cookie separated by vertical bars and then call ``close()``, see
+  ``process_text()``.'''
+  work = [args[0]]
+  for arg in args[1:]:
+    work.append(lambda: vbar_fn(ctx, '|'))
+    work.append(arg)
+
+  work.append(close)
+
+  return work
+
+
 def magic_fn(ctx, token):
   '''Handler for a magic character used to encode templates, template
-  arguments, and parser function calls.'''
+  arguments, and parser function calls.  Returns the work items which
+  process the contents of the magic character, if any, see
+  ``process_text()``.'''
 
   # Close lists if at the beginning of a line
   close_begline_lists(ctx)
@@ -532,75 +561,34 @@ def magic_fn(ctx, token):
   ctx.beginning_of_line = False
   if kind == 'T':
     if nowiki:
-      process_text(ctx, '&lbrace;&lbrace;' + '&vert;'.join(args) +
-                   '&rbrace;&rbrace;')
-      return
+      return ['&lbrace;&lbrace;' + '&vert;'.join(args) + '&rbrace;&rbrace;']
 
     # Template tranclusion or parser function call
     _parser_push(ctx, NodeKind.TEMPLATE)
 
-    # Process arguments
-    process_text(ctx, args[0])
-    for arg in args[1:]:
-      vbar_fn(ctx, '|')
-      process_text(ctx, arg)
-
-    while True:
-      node = ctx.parser_stack[-1]
-      if node.kind == NodeKind.ROOT: break
-      if node.kind in (NodeKind.TEMPLATE, NodeKind.PARSER_FN):
-        _parser_pop(ctx, False)
-        break
-
-      _parser_pop(ctx, True)
+    return _cookie_work(ctx, args, lambda: _parser_close(
+      ctx, (NodeKind.TEMPLATE, NodeKind.PARSER_FN)))
 
   elif kind == 'A':
     if nowiki:
-      process_text(ctx, '&lbrace;&lbrace;&lbrace;' + '&vert;'.join(args) +
-                   '&rbrace;&rbrace;&rbrace;')
-      return
+      return ['&lbrace;&lbrace;&lbrace;' + '&vert;'.join(args) +
+              '&rbrace;&rbrace;&rbrace;']
 
     # Template argument reference
     _parser_push(ctx, NodeKind.TEMPLATE_ARG)
 
-    # Process arguments
-    process_text(ctx, args[0])
-    for arg in args[1:]:
-      vbar_fn(ctx, '|')
-      process_text(ctx, arg)
-
-    while True:
-      node = ctx.parser_stack[-1]
-      if node.kind == NodeKind.ROOT: break
-
-      if node.kind == NodeKind.TEMPLATE_ARG:
-        _parser_pop(ctx, False)
-        break
-
-      _parser_pop(ctx, True)
+    return _cookie_work(ctx, args, lambda: _parser_close(
+      ctx, (NodeKind.TEMPLATE_ARG,)))
 
   elif kind == 'L':
     if nowiki:
-      process_text(ctx, '&lsqb;&lsqb;' + '&vert;'.join(args) + '&rsqb;&rsqb;')
-      return
+      return ['&lsqb;&lsqb;' + '&vert;'.join(args) + '&rsqb;&rsqb;']
 
     # Link to another page
     _parser_push(ctx, NodeKind.LINK)
 
-    # Process arguments
-    process_text(ctx, args[0])
-    for arg in args[1:]:
-      vbar_fn(ctx, '|')
-      process_text(ctx, arg)
-
-    while True:
-      node = ctx.parser_stack[-1]
-      if node.kind == NodeKind.ROOT: break
-      if node.kind == NodeKind.LINK:
-        _parser_pop(ctx, False)
-        break
-
-      _parser_pop(ctx, True)
+    return _cookie_work(ctx, args, lambda: _parser_close(
+      ctx, (NodeKind.LINK,)))
 
   elif kind == 'E':
     # Link to an external page (or just text in brackets, e.g. [...])
@@ -608,27 +596,16 @@ def magic_fn(ctx, token):
         args[0].find(':') >= 0 or args[0].startswith('//')):
       _parser_push(ctx, NodeKind.URL)
 
-      # Process arguments
-      process_text(ctx, args[0])
-      for arg in args[1:]:
-        vbar_fn(ctx, '|')
-        process_text(ctx, arg)
-
-      # The URL could have been popped if the content does not look like
-      # a URL.
-      if not _parser_have(ctx, NodeKind.URL): text_fn(ctx, ']')
-      else:
+      def close():
+        # The URL could have been popped if the content does not look like
+        # a URL.
+        if not _parser_have(ctx, NodeKind.URL): text_fn(ctx, ']')
         # Pop until we are back at this level and close the URL node
-        while True:
-          node = ctx.parser_stack[-1]
-          if node.kind == NodeKind.ROOT: break
-          if node.kind == NodeKind.URL:
-            _parser_pop(ctx, False)
-            break
+        else: _parser_close(ctx, (NodeKind.URL,))
 
-          _parser_pop(ctx, True)
+      return _cookie_work(ctx, args, close)
 
-    else: process_text(ctx, '[' + '&vert;'.join(args) + ']')
+    else: return ['[' + '&vert;'.join(args) + ']']
 
   elif kind == 'N':  # Nowiki
     # Replace nowiki by the escaped versions here
@@ -1416,47 +1393,70 @@ def token_iter(ctx, text):
       if pos != len(part): yield False, part[pos:]
 
 
+def _end_token(ctx, token):
+  '''Updates the line state after a token has been processed.'''
+  ctx.linenum += token.count('\n')
+  ctx.wsp_beginning_of_line = ctx.beginning_of_line and token.isspace()
+  ctx.beginning_of_line = token[-1] == '\n'
+
+
 def process_text(ctx, text):
-  '''Tokenizes ``text`` and processes each token in sequence.  This can be
-  called recursively (which we do to process tokens inside templates and
-  certain other structures).'''
+  '''Tokenizes ``text`` and processes each token in sequence.  Tokens
+  inside templates and certain other structures are processed on an
+  explicit work stack rather than recursively.  The stack holds texts to
+  tokenize, functions to call and the token iterators to resume.'''
+  work = [text]
+
+  while work:
+    item = work.pop()
+    if isinstance(item, str): item = token_iter(ctx, item)
+    elif callable(item):
+      item()
+      continue
 
-  for is_token, token in token_iter(ctx, text):
-    node = ctx.parser_stack[-1]
-    if not is_token: text_fn(ctx, token) # Process it as normal text.
-    elif (node.kind == NodeKind.PRE and not re.match(pre_end_re, token)):
-      # Remove the artificially added prefix from subtitle tokens.
-      # Then process the token as normal text as we are in a
-      # non-interpreting context.
-      if token.startswith('<=='): token = token[1:]
-      elif token.startswith('>=='): token = token[1:]
-      text_fn(ctx, token)
+    for is_token, token in item:
+      node   = ctx.parser_stack[-1]
+      nested = None
 
-    else:
-      # Process it as a token.  In some contexts some tokens may still
-      # be interpreted as text.
-      if token in tokenops: tokenops[token](ctx, token)
-      # Note: < added by tokenizer
-      elif token.startswith('<=='): subtitle_start_fn(ctx, token)
-      # Note: > added by tokenizer
-      elif token.startswith('>=='): subtitle_end_fn(ctx, token)
-      elif token.startswith('<'): tag_fn(ctx, token) # HTML tag like construct
-      elif token.startswith('----'): hline_fn(ctx, token)
-      elif re.match(list_prefix_re, token): list_fn(ctx, token)
-      elif token.startswith('https://') or token.startswith('http://'):
-        url_fn(ctx, token)
-      elif (len(token) == 1 and ord(token) >= MAGIC_FIRST and
-            ord(token) <= MAGIC_LAST):
-        magic_fn(ctx, token)
+      if not is_token: text_fn(ctx, token) # Process it as normal text.
+      elif (node.kind == NodeKind.PRE and not re.match(pre_end_re, token)):
+        # Remove the artificially added prefix from subtitle tokens.
+        # Then process the token as normal text as we are in a
+        # non-interpreting context.
+        if token.startswith('<=='): token = token[1:]
+        elif token.startswith('>=='): token = token[1:]
+        text_fn(ctx, token)
 
       else:
-        t2 = token.strip()
-        if t2 in tokenops: tokenops[t2](ctx, t2)
-        else: text_fn(ctx, token)
+        # Process it as a token.  In some contexts some tokens may still
+        # be interpreted as text.
+        if token in tokenops: tokenops[token](ctx, token)
+        # Note: < added by tokenizer
+        elif token.startswith('<=='): subtitle_start_fn(ctx, token)
+        # Note: > added by tokenizer
+        elif token.startswith('>=='): subtitle_end_fn(ctx, token)
+        elif token.startswith('<'): tag_fn(ctx, token) # HTML tag like
+        elif token.startswith('----'): hline_fn(ctx, token)
+        elif re.match(list_prefix_re, token): list_fn(ctx, token)
+        elif token.startswith('https://') or token.startswith('http://'):
+          url_fn(ctx, token)
+        elif (len(token) == 1 and ord(token) >= MAGIC_FIRST and
+              ord(token) <= MAGIC_LAST):
+          nested = magic_fn(ctx, token)
+
+        else:
+          t2 = token.strip()
+          if t2 in tokenops: tokenops[t2](ctx, t2)
+          else: text_fn(ctx, token)
+
+      if nested:
+        # Process the contents of the token, then the rest of this text
+        work.append(item)
+        work.append(lambda token = token: _end_token(ctx, token))
+        work.extend(reversed(nested))
+        break
 
-    ctx.linenum += token.count('\n')
-    ctx.wsp_beginning_of_line = ctx.beginning_of_line and token.isspace()
-    ctx.beginning_of_line = token[-1] == '\n'
+      _end_token(ctx, token)
 
 
 def parse_encoded(ctx, text):
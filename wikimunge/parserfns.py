@@ -27,67 +27,92 @@ def capitalizeFirstOnly(s):
   return s[0].upper() + s[1:] if s else s
 
 
-def if_fn(ctx, fn_name, args, expander):
+def expanding(fn):
+  '''Makes a parser function of the generator function ``fn``, which
+  yields each argument it needs expanded and is sent its value.  The
+  expander runs ``fn.frame`` on its work stack instead, so nested calls of
+  these functions do not use the Python stack.'''
+  def parser_fn(ctx, fn_name, args, expander):
+    frame = fn(ctx, fn_name, args)
+    value = None
+
+    while True:
+      try: arg = frame.send(value)
+      except StopIteration as e: return e.value
+      value = expander(arg)
+
+  parser_fn.__doc__ = fn.__doc__
+  parser_fn.frame   = fn
+  return parser_fn
+
+
+@expanding
+def if_fn(ctx, fn_name, args):
   '''Implements #if parser function.'''
   arg0 = args[0] if args else ''
   arg1 = args[1] if len(args) >= 2 else ''
   arg2 = args[2] if len(args) >= 3 else ''
-  v = expander(arg0).strip()
+  v = (yield arg0).strip()
 
-  return expander(arg1 if v else arg2).strip()
+  return (yield arg1 if v else arg2).strip()
 
 
-def ifeq_fn(ctx, fn_name, args, expander):
+@expanding
+def ifeq_fn(ctx, fn_name, args):
   '''Implements #ifeq parser function.'''
   arg0 = args[0] if args else ''
   arg1 = args[1] if len(args) >= 2 else ''
   arg2 = args[2] if len(args) >= 3 else ''
   arg3 = args[3] if len(args) >= 4 else ''
 
-  if expander(arg0).strip() == expander(arg1).strip():
-    return expander(arg2).strip()
+  if (yield arg0).strip() == (yield arg1).strip():
+    return (yield arg2).strip()
 
-  return expander(arg3).strip()
+  return (yield arg3).strip()
 
 
-def iferror_fn(ctx, fn_name, args, expander):
+@expanding
+def iferror_fn(ctx, fn_name, args):
   '''Implements the #iferror parser function.'''
-  arg0 = expander(args[0]) if args else ''
+  arg0 = (yield args[0]) if args else ''
   arg1 = args[1] if len(args) >= 2 else None
   arg2 = args[2] if len(args) >= 3 else None
 
   if re.search(r'<[^>]*?\sclass="error"', arg0):
-    return '' if arg1 is None else expander(arg1).strip()
+    return '' if arg1 is None else (yield arg1).strip()
 
-  return arg0 if arg2 is None else expander(arg2).strip()
+  return arg0 if arg2 is None else (yield arg2).strip()
 
 
-def ifexpr_fn(ctx, fn_name, args, expander):
+@expanding
+def ifexpr_fn(ctx, fn_name, args):
   '''Implements #ifexpr parser function.'''
   arg0 = args[0] if args else '0'
   arg1 = args[1] if len(args) >= 2 else ''
   arg2 = args[2] if len(args) >= 3 else ''
-  cond = expr_fn(ctx, fn_name, [arg0], expander)
+  cond = expr_fn(ctx, fn_name, [(yield arg0)], lambda x: x)
 
   try: ret = int(cond)
   except ValueError: ret = 0
 
-  return expander(arg1 if ret else arg2).strip()
+  return (yield arg1 if ret else arg2).strip()
 
 
-def ifexist_fn(ctx, fn_name, args, expander):
+@expanding
+def ifexist_fn(ctx, fn_name, args):
   '''Implements #ifexist parser function.'''
   arg0 = args[0] if args else ''
   arg1 = args[1] if len(args) >= 2 else ''
   arg2 = args[2] if len(args) >= 3 else ''
 
-  exists = ctx.page_exists(expander(arg0).strip())
-  return expander(arg1 if exists else arg2).strip()
+  exists = ctx.page_exists((yield arg0).strip())
+  return (yield arg1 if exists else arg2).strip()
 
 
-def switch_fn(ctx, fn_name, args, expander):
+@expanding
+def switch_fn(ctx, fn_name, args):
   '''Implements #switch parser function.'''
-  val = expander(args[0]).strip() if args else ''
+  val = (yield args[0]).strip() if args else ''
   match_next = False
   defval = None
   last = None
@@ -97,17 +122,17 @@ def switch_fn(ctx, fn_name, args, expander):
     m = re.match(r'(?s)^([^=]*)=(.*)$', arg)
 
     if not m:
-      last = expander(arg).strip()
+      last = (yield arg).strip()
       if last == val: match_next = True
       continue
 
     k, v = m.groups()
-    k = expander(k).strip()
-    if k == val or match_next: return expander(v).strip()
+    k = (yield k).strip()
+    if k == val or match_next: return (yield v).strip()
     if k == '#default': defval = v
     last = None
 
-  if defval is not None: return expander(defval).strip()
+  if defval is not None: return (yield defval).strip()
   return last or ''
 
 
@@ -1243,16 +1268,33 @@ PARSER_FUNCTIONS = {
   '#section-x':          unimplemented_fn,
 }
 
+# Parser functions whose value can depend on the page being expanded or on
+# the current time
+PAGE_DEPENDENT_FUNCTIONS = {
+  name for name in PARSER_FUNCTIONS if name.startswith('CURRENT')} | {
+  'FULLPAGENAME', 'PAGENAME', 'BASEPAGENAME', 'ROOTPAGENAME', 'SUBPAGENAME',
+  'TALKPAGENAME', 'NAMESPACENUMBER', 'NAMESPACE', 'SUBJECTSPACE', 'TALKSPACE',
+  'FULLPAGENAMEE', 'PAGENAMEE', 'ROOTPAGENAMEE', 'CUEEWNTDOW', '#time',
+  'localurl',
+}
 
-def call_parser_function(ctx, fn_name, args, expander):
-  '''Calls the given parser function with the given arguments.'''
+# Parser functions that MediaWiki counts as expensive, see
+# Context.over_limit()
+EXPENSIVE_FUNCTIONS = {
+  '#ifexist', '#lst', 'PAGESIZE', 'PAGESINCATEGORY', 'PROTECTIONLEVEL',
+  'PROTECTIONEXPIRY',
+}
+
+
+def parser_function(ctx, fn_name, args):
+  '''Returns the given parser function and its arguments converted to the
+  form it accepts, or None and the error output.'''
   assert isinstance(fn_name, str)
   assert isinstance(args, (list, tuple, dict))
-  assert callable(expander)
 
   if fn_name not in PARSER_FUNCTIONS:
     ctx.error('unrecognized parser function %s' % fn_name)
-    return ''
+    return None, ''
 
   fn = PARSER_FUNCTIONS[fn_name]
   accept_keyed_args = False
@@ -1301,6 +1343,14 @@ def call_parser_function(ctx, fn_name, args, expander):
   if have_keyed_args and not accept_keyed_args:
     ctx.error('parser function %s does not support named arguments: %s' % (
       fn_name, args))
-    return ''
+    return None, ''
+
+  return fn, args
+
+
+def call_parser_function(ctx, fn_name, args, expander):
+  '''Calls the given parser function with the given arguments.'''
+  assert callable(expander)
 
-  return fn(ctx, fn_name, args, expander)
+  fn, args = parser_function(ctx, fn_name, args)
+  return '' if fn is None else fn(ctx, fn_name, args, expander)
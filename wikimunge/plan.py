@@ -0,0 +1,89 @@
+import re
+
+from .common  import MAGIC_FIRST, MAGIC_LAST
+from .encoder import EncodedText
+
+
+_cookie_re = re.compile('[%c-%c]' % (MAGIC_FIRST, MAGIC_LAST))
+_named_re  = re.compile(r'(?s)^\s*([^][&<>="\']+?)\s*=')
+_invalid_re = re.compile(r'[][&<>"\']') # Characters not allowed in names
+
+
+def arg_key(name):
+  '''Returns the key of an expanded template argument name.'''
+  name = name.strip()
+  if name.isdigit(): return int(name)
+  return re.sub(r'\s+', ' ', name).strip()
+
+
+def _split(nodes):
+  '''Returns ``(name, offset)`` if a call argument is named ``name`` and its
+  value starts at ``offset`` whatever the template arguments are, False if
+  it is never named and None if it depends on the template arguments.'''
+  first = nodes[0] if nodes and isinstance(nodes[0], str) else ''
+
+  m = _named_re.match(first)
+  if m: return m.group(1), first.index('=') + 1
+
+  # Names end at the first equals sign
+  if len(nodes) <= 1 and (first or not nodes): return False
+  if '=' in first or _invalid_re.search(first): return False
+
+
+class TemplatePlan(EncodedText):
+  '''A template body compiled for transclusion.  ``nodes`` is the encoded
+  body as a list of:
+
+    str                           text without cookies
+    ('A', key, name, default, i)  template argument reference
+    ('T', args, split)            template or parser function call
+    ('L', args)                   link
+    ('E', args)                   external link
+    ('R', i)                      cookie copied as is
+
+  where ``name``, ``default`` and each of ``args`` are lists of nodes and
+  ``i`` indexes the cookie of the node.  ``key`` is the argument key if
+  the name has no cookies, ``default`` is None if the reference has no
+  default.  ``split`` holds the result of ``_split()`` for each argument
+  after the name of a call.  Calls, links and arguments with <nowiki /> are
+  copied as is, to be left unexpanded.'''
+
+  def __init__(self, body):
+    super().__init__(body)
+    self.nodes = self.compile(self.text)
+
+
+  def compile(self, text):
+    nodes = []
+    pos   = 0
+
+    for m in _cookie_re.finditer(text):
+      if pos < m.start(): nodes.append(text[pos:m.start()])
+      pos = m.end()
+
+      i = ord(m.group(0)) - MAGIC_FIRST
+      kind, args, nowiki = self.cookies[i]
+
+      if nowiki or kind not in ('A', 'T', 'L', 'E'):
+        nodes.append(('R', i))
+
+      elif kind == 'A':
+        name    = self.compile(args[0])
+        default = self.compile(args[1]) if 2 <= len(args) else None
+
+        key = None
+        if not _cookie_re.search(args[0]):
+          try: key = arg_key(args[0])
+          except ValueError: pass # Raised again when expanded
+
+        nodes.append(('A', key, name, default, i))
+
+      elif kind == 'T':
+        args = [self.compile(arg) for arg in args]
+        nodes.append(('T', args, tuple(_split(arg) for arg in args[1:])))
+
+      else: nodes.append((kind, [self.compile(arg) for arg in args]))
+
+    if pos < len(text): nodes.append(text[pos:])
+
+    return nodes
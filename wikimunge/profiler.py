@@ -0,0 +1,62 @@
+import time
+
+
+class Profiler:
+  '''Profiles the expansion of templates and parser functions.  For each
+  canonical template name and parser function name, ``stats`` holds the
+  number of calls, the inclusive and exclusive wall time in seconds and the
+  length of the output in characters.  Exclusive time leaves out the time of
+  the calls nested in a call.'''
+
+  def __init__(self):
+    self.stats = {} # Name -> [calls, inclusive, exclusive, output]
+    self.stack = [] # Time of the calls nested in each open call
+
+
+  def enter(self):
+    '''Starts timing a call, returns the value to pass to ``leave()``.'''
+    self.stack.append(0)
+    return time.perf_counter()
+
+
+  def leave(self, name, start, size):
+    '''Ends timing a call which output ``size`` characters.'''
+    elapsed = time.perf_counter() - start
+    nested  = self.stack.pop()
+    if self.stack: self.stack[-1] += elapsed
+
+    stats = self.stats.get(name)
+    if stats is None: stats = self.stats[name] = [0, 0, 0, 0]
+
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] += elapsed - nested
+    stats[3] += size
+
+
+  def reset(self):
+    '''Drops the calls left open by an exception, call for each page.'''
+    del self.stack[:]
+
+
+  def merge(self, stats):
+    '''Adds the ``stats`` of another profiler, e.g. from a worker.'''
+    for name, other in stats.items():
+      stats = self.stats.get(name)
+      if stats is None: stats = self.stats[name] = [0, 0, 0, 0]
+
+      for i, value in enumerate(other): stats[i] += value
+
+
+  def report(self, f, key = 'exclusive', top = None):
+    '''Writes the stats to the file ``f`` sorted by ``key``, one of 'calls',
+    'inclusive', 'exclusive' or 'output', largest first.'''
+    i     = ('calls', 'inclusive', 'exclusive', 'output').index(key)
+    items = sorted(self.stats.items(), key = lambda x: x[1][i], reverse = True)
+
+    f.write('{:>10} {:>10} {:>10} {:>12}  {}\n'.format(
+      'calls', 'incl s', 'excl s', 'output', 'name'))
+
+    for name, (calls, incl, excl, output) in items[:top]:
+      f.write('{:10,} {:10.3f} {:10.3f} {:12,}  {}\n'.format(
+        calls, incl, excl, output, name))
@@ -0,0 +1,137 @@
+import io
+import os
+
+from .dumpfile       import OPENERS
+from .mediawikiexpat import MediaWikiExpat
+from .multistream    import MediaWikiMultiStream, read_multistream_index, \
+  read_stream_pages
+
+
+def _find(f, pattern, offset, end, reverse = False):
+  '''Returns the offset of the first, or last if ``reverse``, occurrence of
+  ``pattern`` in the file between ``offset`` and ``end`` or None.'''
+  size = 1 << 20
+
+  while offset < end:
+    start = max(offset, end - size) if reverse else offset
+    f.seek(start)
+    data = f.read(min(size, end - start) + len(pattern) - 1)
+
+    i = data.rfind(pattern) if reverse else data.find(pattern)
+    if i != -1: return start + i
+
+    if reverse: end = start
+    else: offset = start + size
+
+
+class DumpSlice:
+  '''A file-like view of a byte range of <page> elements of an uncompressed
+  dump, wrapped in a <mediawiki> root element.'''
+
+  def __init__(self, path, start, end):
+    self.f      = open(path, 'rb')
+    self.remain = end - start
+    self.head   = b'<mediawiki>'
+    self.tail   = b'</mediawiki>'
+
+    self.f.seek(start)
+
+
+  def read(self, size = -1):
+    if self.head:
+      data, self.head = self.head, b''
+      return data
+
+    if self.remain:
+      data = self.f.read(self.remain if size < 0 else min(size, self.remain))
+      self.remain = self.remain - len(data) if data else 0
+      if data: return data
+
+    data, self.tail = self.tail, b''
+    return data
+
+
+  def close(self): self.f.close()
+  def __enter__(self): return self
+  def __exit__(self, *args): self.close()
+
+
+class MediaWikiShards:
+  '''Splits an uncompressed dump at <page> boundaries, or a multistream dump
+  at stream boundaries, into shards which can be parsed independently.
+  ``info`` is the revision metadata of the last page parsed.'''
+
+  def __init__(self, path, count, index = None, page_filter = None):
+    self.path        = path
+    self.index       = index
+    self.page_filter = page_filter
+    self.namespaces  = {}
+    self.info        = None
+
+    if index is not None: self.shards = self.split_streams(count)
+    elif os.path.splitext(path)[1] in OPENERS:
+      raise Exception('Sharded loading requires an uncompressed or '
+                      'multistream dump')
+    else: self.shards = self.split_pages(count)
+
+
+  def split_streams(self, count):
+    offsets = read_multistream_index(self.index)
+    if not offsets: raise Exception('Empty multistream index %s' % self.index)
+
+    reader = MediaWikiMultiStream(self.index)
+    reader.parse_header(self.path, offsets[0])
+    self.namespaces = reader.namespaces
+
+    ends = offsets[1:] + [None]
+    streams = list(zip(offsets, ends))
+    size = -(-len(streams) // count)
+
+    return [streams[i : i + size] for i in range(0, len(streams), size)]
+
+
+  def split_pages(self, count):
+    with open(self.path, 'rb') as f:
+      size  = os.fstat(f.fileno()).st_size
+      first = _find(f, b'<page>', 0, size)
+      end   = _find(f, b'</mediawiki>', 0, size, reverse = True)
+
+      if first is None or end is None: return []
+
+      # The header holds <siteinfo>
+      f.seek(0)
+      header = f.read(first) + b'</mediawiki>'
+
+      reader = MediaWikiExpat()
+      for page in reader.read_file(io.BytesIO(header)): pass
+      self.namespaces = reader.namespaces
+
+      # Move approximate split points forward to the next <page>
+      starts = {first}
+      for i in range(1, count):
+        offset = _find(f, b'<page>', first + (end - first) * i // count, end)
+        if offset is not None: starts.add(offset)
+
+    starts = sorted(starts)
+
+    return list(zip(starts, starts[1:] + [end]))
+
+
+  def parse(self, shard, handler):
+    '''Parses the pages of one shard.'''
+    shard = self.shards[shard]
+
+    if self.index is not None:
+      for start, end in shard:
+        pages = read_stream_pages(
+          self.path, start, end, self.namespaces, self.page_filter)
+
+        for self.info, page in pages: handler(*page)
+
+    else:
+      reader = MediaWikiExpat(self.namespaces, self.page_filter)
+
+      with DumpSlice(self.path, *shard) as f:
+        for page in reader.read_file(f):
+          self.info = reader.info
+          handler(*page)
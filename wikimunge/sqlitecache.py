@@ -0,0 +1,264 @@
+import pickle
+import sqlite3
+import collections.abc
+
+from .cache import PageCache
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+  title     TEXT PRIMARY KEY,
+  ns        TEXT NOT NULL,
+  model     TEXT NOT NULL,
+  size      INTEGER NOT NULL,
+  text      TEXT NOT NULL,
+  id        INTEGER,
+  revid     INTEGER,
+  timestamp TEXT,
+  sha1      TEXT
+);
+CREATE INDEX IF NOT EXISTS pages_ns    ON pages (ns, model);
+CREATE INDEX IF NOT EXISTS pages_model ON pages (model);
+
+CREATE TABLE IF NOT EXISTS templates (
+  name TEXT PRIMARY KEY,
+  body TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS state (
+  key   TEXT PRIMARY KEY,
+  value BLOB
+);
+'''
+
+COLUMNS    = ('title', 'ns', 'model', 'size', 'text', 'id', 'revid',
+              'timestamp', 'sha1')
+INSERT     = 'INSERT OR REPLACE INTO pages (%s) VALUES (%s)' % (
+  ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+BATCH_SIZE = 1000
+
+
+class SQLiteMapping(collections.abc.MutableMapping):
+  '''A mapping view of the rows of a table matching ``where``.  Values are
+  tuples of ``columns`` or the value of a single column.  Only mappings of a
+  whole table are writable.  If ``memo`` is True, the values looked up, and
+  the keys found missing, are kept in memory.'''
+
+  def __init__(self, cache, table, key, columns, where = None, memo = False):
+    cols = ', '.join(columns)
+    cond = ' AND ' + where if where else ''
+
+    self.cache    = cache
+    self.single   = len(columns) == 1
+    self.writable = where is None
+    self.get_sql  = 'SELECT %s FROM %s WHERE %s = ?%s' % (
+      cols, table, key, cond)
+    self.all_sql  = 'SELECT %s, %s FROM %s WHERE %s' % (
+      key, cols, table, where or 1)
+    self.len_sql  = 'SELECT count(*) FROM %s WHERE %s' % (table, where or 1)
+    self.set_sql  = 'INSERT OR REPLACE INTO %s (%s, %s) VALUES (%s)' % (
+      table, key, cols, ', '.join('?' * (len(columns) + 1)))
+    self.del_sql  = 'DELETE FROM %s WHERE %s = ?' % (table, key)
+    self.memo     = {} if memo else None # Key -> value or None if missing
+
+
+  def get_row(self, key):
+    '''Returns the value of ``key`` or None.'''
+    if self.memo is not None and key in self.memo: return self.memo[key]
+
+    row = self.cache.execute(self.get_sql, (key,)).fetchone()
+    if row is not None and self.single: row = row[0]
+    if self.memo is not None: self.memo[key] = row
+
+    return row
+
+
+  def __getitem__(self, key):
+    row = self.get_row(key)
+    if row is None: raise KeyError(key)
+    return row
+
+
+  def __contains__(self, key): return self.get_row(key) is not None
+
+
+  def __setitem__(self, key, value):
+    if not self.writable: raise Exception('Read-only view: ' + self.get_sql)
+    if self.single: value = (value,)
+    self.cache.execute(self.set_sql, (key,) + tuple(value))
+    if self.memo is not None: self.memo.pop(key, None)
+
+
+  def __delitem__(self, key):
+    if key not in self: raise KeyError(key)
+    self.cache.execute(self.del_sql, (key,))
+    if self.memo is not None: self.memo.pop(key, None)
+
+
+  def __iter__(self):
+    for row in self.cache.execute(self.all_sql).fetchall(): yield row[0]
+
+
+  def __len__(self): return self.cache.execute(self.len_sql).fetchone()[0]
+
+
+  def items(self):
+    for row in self.cache.execute(self.all_sql).fetchall():
+      yield row[0], row[1] if self.single else row[1:]
+
+
+class SQLitePageCache(PageCache):
+  '''Stores pages in the SQLite database ``cache.sqlite`` in WAL mode.
+  Pages are inserted in batches and committed at checkpoints and on
+  ``save()``, so an interrupted load rolls back to its last checkpoint.
+  Page values are ``(model, rowid, size)``.  Template bodies are kept in
+  memory once read, as expansion looks them up for every call.'''
+
+  def __init__(self, name_data, path, compress = None):
+    if compress is not None:
+      raise Exception('The sqlite cache does not support compression')
+
+    self.db    = None
+    self.batch = []
+
+    super().__init__(name_data, path)
+
+
+  def connect(self):
+    self.db = sqlite3.connect(self.path + '/cache.sqlite',
+                              isolation_level = None)
+    self.db.execute('PRAGMA journal_mode = WAL')
+    self.db.execute('PRAGMA synchronous = NORMAL')
+    self.db.executescript(SCHEMA)
+    self.db.execute('BEGIN')
+
+
+  def execute(self, sql, args = ()):
+    '''Runs a statement after writing any batched pages.  The database is
+    opened on first use in each process.'''
+    if self.db is None: self.connect()
+    if self.batch: self.flush()
+    return self.db.execute(sql, args)
+
+
+  def get_state(self, key):
+    row = self.execute('SELECT value FROM state WHERE key = ?',
+                       (key,)).fetchone()
+    if row is not None: return pickle.loads(row[0])
+
+
+  def set_state(self, key, value):
+    self.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                 (key, pickle.dumps(value)))
+
+
+  def commit(self):
+    self.execute('COMMIT')
+    self.db.execute('BEGIN')
+
+
+  def load(self):
+    self.pages     = SQLiteMapping(
+      self, 'pages', 'title', ('model', 'rowid', 'size'))
+    self.redirects = SQLiteMapping(
+      self, 'pages', 'title', ('text',), "model = 'redirect'")
+    self.templates = SQLiteMapping(
+      self, 'templates', 'name', ('body',), memo = True)
+    self.revisions = SQLiteMapping(
+      self, 'pages', 'title', ('id', 'revid', 'timestamp', 'sha1'),
+      'coalesce(id, revid, timestamp, sha1) IS NOT NULL')
+
+    self.complete   = bool(self.get_state('complete'))
+    self.checkpoint = self.get_state('checkpoint')
+
+
+  def save(self):
+    self.set_state('complete', True)
+    self.execute("DELETE FROM state WHERE key = 'checkpoint'")
+    self.commit()
+
+    self.complete   = True
+    self.checkpoint = None
+
+
+  def clear(self):
+    '''Removes all pages and any checkpoint.'''
+    self.batch = []
+
+    for table in ('pages', 'templates', 'state'):
+      self.execute('DELETE FROM ' + table)
+    self.commit()
+    self.templates.memo.clear()
+
+    self.rev_redirect = None
+    self.complete     = False
+    self.checkpoint   = None
+
+
+  def close(self):
+    '''Closes the database.  Changes since the last checkpoint or
+    ``save()`` are discarded.'''
+    if self.db is not None: self.db.close()
+    self.db    = None
+    self.batch = []
+
+
+  def remap(self):
+    '''Commits and closes the database before forking, SQLite connections
+    must not be shared by processes.  Each process reopens it on first
+    use.'''
+    if self.db is None: return
+    self.commit()
+    self.close()
+
+
+  def merge(self, other):
+    '''Copies the pages and templates of another saved cache.  Pages in
+    ``other`` replace pages with the same title.'''
+    cols = ', '.join(COLUMNS)
+
+    self.execute('SELECT 1') # Flush batch
+    self.db.executemany(
+      INSERT, other.execute('SELECT %s FROM pages' % cols))
+    self.db.executemany(
+      'INSERT OR REPLACE INTO templates (name, body) VALUES (?, ?)',
+      other.execute('SELECT name, body FROM templates'))
+
+    self.templates.memo.clear()
+    self.rev_redirect = None
+
+
+  def save_checkpoint(self, checkpoint):
+    '''Commits the pages loaded so far along with the reader
+    ``checkpoint``.'''
+    self.set_state('checkpoint', checkpoint)
+    self.commit()
+    self.checkpoint = checkpoint
+
+
+  def flush(self, ns = None):
+    '''Inserts batched pages.'''
+    batch, self.batch = self.batch, []
+    self.db.executemany(INSERT, batch)
+
+
+  def store(self, model, title, text, info):
+    if self.db is None: self.connect()
+
+    size = len(text.encode('utf-8'))
+    info = info or (None, None, None, None)
+    self.batch.append(
+      (title, self.namespace(title), model, size, text) + tuple(info))
+
+    if BATCH_SIZE <= len(self.batch): self.flush()
+
+
+  def read(self, title):
+    '''Reads page contents. Returns None if the page does not exist.'''
+    assert isinstance(title, str)
+
+    if title.startswith('Main:'): title = title[5:]
+
+    row = self.execute('SELECT text FROM pages WHERE title = ?',
+                       (title,)).fetchone()
+    if row is not None: return row[0]
@@ -1,13 +1,30 @@
+import os
 import time
+import shutil
 import traceback
 import multiprocessing
+import multiprocessing.connection
 import pkg_resources
 
-from .mediawikisax    import MediaWikiSAX
+from .mediawikiexpat  import MediaWikiExpat
+from .multistream     import MediaWikiMultiStream
+from .shards          import MediaWikiShards
 from .cache           import PageCache
+from .sqlitecache     import SQLitePageCache
 from .context         import Context
 from .namespace_data  import NamespaceData
 from .page_proc_timer import PageProcTimer
+from .common          import find_section
+
+
+# Stages of processing a page in reprocess()
+STAGES = ('read', 'handler', 'expand', 'parse')
+
+# Page cache storage backends
+BACKENDS = {
+  'file':   PageCache,
+  'sqlite': SQLitePageCache,
+}
 
 
 def _handler(*args, **kwargs):
@@ -17,8 +34,13 @@ def _handler(*args, **kwargs):
 
 class WikiMunge:
   def __init__(self, lang, outdir, template_filter = None, log = None,
-               threads = None):
-    self.threads = threads
+               threads = None, compress = None, backend = 'file',
+               memo_size = 0, limits = None, profile = False, rope = False,
+               log_level = 'DEBUG'):
+    self.threads   = threads
+    self.page_info = None # Revision metadata of the page being loaded
+    self.stages    = None # Stage of each worker of reprocess()
+    self.failures  = []   # Pages which failed in reprocess()
 
     # Log
     if isinstance(log, str): log = open(log, 'w')
@@ -28,65 +50,386 @@ class WikiMunge:
     path = pkg_resources.resource_filename('wikimunge', path)
     self.name_data = NamespaceData(path)
 
-    self.cache = PageCache(self.name_data, outdir)
+    # Page cache, the file backend can compress with 'zlib' or 'lzma'
+    if backend not in BACKENDS:
+      raise Exception('Unknown cache backend %s' % backend)
+
+    self.cache = BACKENDS[backend](self.name_data, outdir, compress)
+    # Template expansions are memoized up to memo_size characters, limits
+    # overrides the expansion limits of each page in context.LIMITS and
+    # profile enables the profiler, see profile_report().  rope expands
+    # nested templates into one output list instead of joining each one.
+    # Messages below log_level, one of context.LEVELS, are dropped.
     self.ctx   = Context(self.name_data, self.cache,
-                         template_filter = template_filter, log = log)
+                         template_filter = template_filter, log = log,
+                         memo_size = memo_size, limits = limits,
+                         profile = profile, rope = rope,
+                         log_level = log_level)
 
 
   def parse(self, title, text):
+    self.set_stage('parse')
     self.ctx.start_page(title)
-    return self.ctx.parse(text)
+    ret = self.ctx.parse(text)
+    self.set_stage('handler')
+
+    return ret
 
 
   def expand(self, title, text):
+    self.set_stage('expand')
     self.ctx.start_page(title)
-    return self.ctx.expand(text)
+    ret = self.ctx.expand(text)
+    self.set_stage('handler')
+
+    return ret
+
+
+  def _section(self, title, heading, level, text):
+    '''Returns the section of the page under ``heading`` at ``level``.
+    ``text`` defaults to the cached page.'''
+    if text is None: text = self.cache.read(title)
+    if text is not None: return find_section(text, heading, level)
+
+
+  def parse_section(self, title, heading, level = 2, text = None):
+    '''Parses only the section of the page ``title`` under ``heading`` at
+    ``level``, see ``expand_section()``.'''
+    text = self._section(title, heading, level, text)
+    if text is not None: return self.parse(title, text)
+
+
+  def expand_section(self, title, heading, level = 2, text = None):
+    '''Expands only the section of the page ``title`` under ``heading`` at
+    ``level``, including the heading line.  ``text`` defaults to the
+    cached page.  Returns None if the page has no such section.'''
+    text = self._section(title, heading, level, text)
+    if text is not None: return self.expand(title, text)
 
 
   def add_page(self, model, title, text):
-    self.cache.add(model, title, text)
+    self.cache.add(model, title, text, self.page_info)
 
 
-  def reprocess(self, queue, page_handler):
-    global _global_page_handler
+  def reprocess(self, queue, page_handler, timeout = None):
+    '''Calls ``page_handler(title, text)`` for the titles in ``queue`` in
+    parallel worker processes and yields the values that are not None.
 
-    def local_handler(title):
-      try:
-        text = self.cache.read(title)
-        return True, page_handler(title, text)
+    A worker that spends more than ``timeout`` seconds on a page, or dies,
+    is killed and replaced.  Pages which failed are listed in
+    ``self.failures`` as ``(title, stage, message)`` where ``stage`` is
+    one of STAGES.  The profile and template memo counts of each page
+    handled by a worker are merged into those of this instance.'''
+    stages = multiprocessing.Array('b', self.threads or
+                                   multiprocessing.cpu_count(), lock = False)
+    self.failures = []
 
-      except Exception as e:
-        trace = ''.join(traceback.format_exception(
-          type(e), value = e, tb = e.__traceback__))
-        return False, 'Exception in %s:\n%s' % (title, trace)
+    def worker(conn, slot):
+      self.stages, self.slot = stages, slot
 
-    _global_page_handler = local_handler
+      # The profile and memo counts forked from this process were already
+      # counted
+      profiler = self.ctx.profiler
+      memo     = self.ctx.template_memo
+      if profiler: profiler.stats = {}
+      if memo: memo.take_counts()
 
-    pool  = multiprocessing.Pool(self.threads)
-    timer = PageProcTimer(len(queue))
+      while True:
+        title = conn.recv()
+        if title is None: break
 
-    for success, ret in pool.imap_unordered(_handler, queue):
-      if not success: print(ret)
-      elif ret is not None: yield ret
+        try:
+          self.set_stage('read')
+          text = self.cache.read(title)
+          self.set_stage('handler')
+          result = True, page_handler(title, text)
 
-      timer.inc()
+        except Exception as e:
+          trace = ''.join(traceback.format_exception(
+            type(e), value = e, tb = e.__traceback__))
+          result = False, 'Exception in %s:\n%s' % (title, trace)
 
-    pool.close()
-    pool.join()
+        # Return the profile and memo counts of the page with its result
+        stats = counts = None
+        if profiler: stats, profiler.stats = profiler.stats, {}
+        if memo: counts = memo.take_counts()
+        conn.send(result + (stats, counts))
+
+    def start(slot):
+      conn, child_conn = multiprocessing.Pipe()
+      proc = multiprocessing.Process(
+        target = worker, args = (child_conn, slot), daemon = True)
+      proc.start()
+      child_conn.close()
+
+      return proc, conn
+
+    # Workers share the mapping of the cache file
+    self.cache.remap()
+
+    workers = [start(slot) for slot in range(len(stages))]
+    busy    = {} # Slot -> title, deadline
+    titles  = iter(queue)
+    timer   = PageProcTimer(len(queue))
+
+    def dispatch(slot):
+      title = next(titles, None)
+      if title is None: return
+
+      stages[slot] = 0
+      workers[slot][1].send(title)
+      busy[slot] = title, time.time() + timeout if timeout else None
+
+    def fail(slot, message):
+      title = busy.pop(slot)[0]
+      stage = STAGES[stages[slot]]
+      self.failures.append((title, stage, message))
+      print('Page %s failed during %s: %s' % (title, stage, message))
+
+    def restart(slot):
+      proc, conn = workers[slot]
+      proc.kill()
+      proc.join()
+      conn.close()
+      workers[slot] = start(slot)
+
+    try:
+      for slot in range(len(workers)): dispatch(slot)
+
+      while busy:
+        conns = {workers[slot][1]: slot for slot in busy}
+        wait  = None
+        if timeout:
+          deadline = min(deadline for title, deadline in busy.values())
+          wait     = max(0, deadline - time.time())
+
+        for conn in multiprocessing.connection.wait(list(conns), wait):
+          slot = conns[conn]
+
+          died = False
+          try: success, ret, stats, counts = conn.recv()
+          except EOFError:
+            fail(slot, 'worker died')
+            died = True
+
+          else:
+            if stats: self.ctx.profiler.merge(stats)
+            if counts: self.ctx.template_memo.merge(counts)
+            if not success: fail(slot, ret)
+            else:
+              busy.pop(slot)
+              if ret is not None: yield ret
+
+          # Outside of the except clause, so that the exceptions of the new
+          # worker are not chained to the EOFError
+          if died: restart(slot)
+
+          timer.inc()
+          dispatch(slot)
+
+        # Kill the workers stuck past their deadline
+        now = time.time()
+        for slot, (title, deadline) in list(busy.items()):
+          if deadline is None or now < deadline: continue
+
+          fail(slot, 'timeout after %s seconds' % timeout)
+          restart(slot)
+          timer.inc()
+          dispatch(slot)
+
+      for proc, conn in workers: conn.send(None)
+      for proc, conn in workers: proc.join()
+
+    finally:
+      for proc, conn in workers:
+        if proc.is_alive(): proc.kill()
+
+      self.stages = None
+
+
+  def profile_report(self, path, key = 'exclusive'):
+    '''Writes the profile of the templates and parser functions, including
+    those of the workers of ``reprocess()``, to ``path``.  See
+    ``Profiler.report()``.'''
+    with open(path, 'w') as f: self.ctx.profiler.report(f, key)
+
+
+  def set_stage(self, stage):
+    '''Records the stage of the page being processed by a worker of
+    ``reprocess()``.'''
+    if self.stages is not None: self.stages[self.slot] = STAGES.index(stage)
+
+
+  def resume_state(self):
+    '''Returns the caller state saved with the last checkpoint of an
+    interrupted ``process()`` or None.'''
+    checkpoint = self.cache.checkpoint
+    if checkpoint is not None: return checkpoint['state']
+
+
+  def process(self, path, page_handler, index = None, page_filter = None,
+              state = None, checkpoint_interval = 300):
+    '''Loads pages from the dump file at ``path``.  If ``index`` is the
+    path to a multistream index file then ``path`` is read as a multistream
+    dump and decompressed in parallel.  ``page_filter(model, ns, title)``
+    may return False to skip a page before its text is read.
+
+    Every ``checkpoint_interval`` seconds the input position and the page
+    index are checkpointed along with the return value of ``state()``, if
+    given.  An interrupted load resumes from its last checkpoint.'''
+
+    if index is None: reader = MediaWikiExpat(page_filter = page_filter)
+    else: reader = MediaWikiMultiStream(index, self.threads, page_filter)
 
+    # Resume
+    checkpoint = self.cache.checkpoint
+    position   = None
+    count      = 0
+
+    if checkpoint is not None:
+      if checkpoint['multistream'] != (index is not None):
+        raise Exception('Checkpoint does not match the input type')
+
+      reader.namespaces = checkpoint['namespaces']
+      position = checkpoint['position']
+      count    = checkpoint['count']
+      print('Resuming after {:,} pages'.format(count))
 
-  def process(self, path, page_handler):
     # Load pages
     timer = PageProcTimer()
+    last  = time.time()
 
     def handler(*args):
+      nonlocal count, last
+
+      self.page_info = reader.info
       page_handler(*args)
       timer.inc()
+      count += 1
+
+      if checkpoint_interval and last + checkpoint_interval < time.time():
+        self.cache.save_checkpoint(dict(
+          multistream = index is not None,
+          position    = reader.position,
+          namespaces  = reader.namespaces,
+          count       = count,
+          state       = state() if state else None))
+        last = time.time()
+
+    reader.parse(path, handler, position)
+    self.page_info = None
+
+    # Redirect Templates
+    self.cache.redirect_templates()
+
+    # Save cache
+    self.cache.save()
+
+
+  def process_parallel(self, path, page_handler, index = None,
+                       page_filter = None, state = None):
+    '''Loads pages like ``process()`` but splits an uncompressed or
+    multistream dump into shards which are loaded by parallel worker
+    processes.  Each worker writes its own cache segment and the segments
+    are then merged into this cache.  Loading always starts from scratch.
+
+    ``page_handler`` runs in the workers so any state it keeps must be
+    returned by ``state()``.  A list of the shard states, in dump order, is
+    returned.'''
+    global _global_page_handler
+
+    self.cache.clear()
+
+    count   = self.threads or multiprocessing.cpu_count()
+    shards  = MediaWikiShards(path, count, index, page_filter)
+    count   = len(shards.shards)
+    seg_dir = self.cache.path + '/segments/%d'
+
+    def load_shard(shard):
+      # Runs in a forked worker, so replacing the cache is local to it
+      os.makedirs(seg_dir % shard, exist_ok = True)
+      self.cache = self.ctx.cache = type(self.cache)(
+        self.name_data, seg_dir % shard, self.cache.compress)
+      self.cache.clear()
+
+      def handler(*args):
+        self.page_info = shards.info
+        page_handler(*args)
+
+      shards.parse(shard, handler)
+      self.cache.save()
+      self.cache.close()
+
+      return state() if state else None
+
+    _global_page_handler = load_shard
+
+    # One fresh worker per shard so no handler state leaks between shards
+    pool   = multiprocessing.Pool(count or 1, maxtasksperchild = 1)
+    states = []
 
-    MediaWikiSAX().parse(path, handler)
+    for ret in pool.imap(_handler, range(count)):
+      states.append(ret)
+      print('  ... loaded shard {} of {}'.format(len(states), count))
+
+    pool.close()
+    pool.join()
+
+    # Merge segments
+    for shard in range(count):
+      segment = type(self.cache)(self.name_data, seg_dir % shard)
+      self.cache.merge(segment)
+      segment.close()
+
+    if count: shutil.rmtree(self.cache.path + '/segments')
 
     # Redirect Templates
     self.cache.redirect_templates()
 
     # Save cache
     self.cache.save()
+
+    return states
+
+
+  def update(self, path, page_handler, index = None, page_filter = None):
+    '''Updates a complete cache from a newer dump.  Pages whose revision
+    is already cached are skipped, changed pages are passed to
+    ``page_handler`` and appended and pages no longer in the dump are
+    tombstoned.  Returns the set of titles added or changed and the set of
+    titles no longer in the cache.'''
+    if index is None: reader = MediaWikiExpat(page_filter = page_filter)
+    else: reader = MediaWikiMultiStream(index, self.threads, page_filter)
+
+    timer   = PageProcTimer()
+    before  = set(self.cache.pages)
+    seen    = set()
+    changed = set()
+
+    def handler(model, ns, title, text):
+      timer.inc()
+      seen.add(title)
+
+      if self.cache.has_revision(title, reader.info): return
+
+      # Drop the old version, the handler may not add the page again
+      self.cache.remove(title)
+
+      self.page_info = reader.info
+      page_handler(model, ns, title, text)
+
+      if title in self.cache.pages: changed.add(title)
+
+    reader.parse(path, handler)
+    self.page_info = None
+
+    for title in set(self.cache.pages) - seen: self.cache.remove(title)
+    deleted = before - set(self.cache.pages)
+
+    # Redirect Templates
+    self.cache.redirect_templates(refresh = True)
+
+    # Save cache
+    self.cache.save()
+
+    return changed, deleted
@@ -6,7 +6,8 @@ import re
 import html
 import argparse
 
-from wikimunge import WikiMunge, WikiNode, NodeKind
+from wikimunge        import WikiMunge, WikiNode, NodeKind
+from wikimunge.common import find_section
 
 json_args = dict(ensure_ascii = False, indent = 2, separators = (',', ': '))
 chars = '0123456789aáâåäbcdeéfghijklmnoóöõpqrsšștuüvwxyzž '
@@ -414,12 +415,16 @@ def sanitize_text(text):
 
 class WiktionaryExtractor:
   def __init__(self, config, outdir, threads, log = None, expand_only = False,
-               match_title = None, max_pages = None):
+               match_title = None, max_pages = None, compress = None,
+               backend = 'file', page_timeout = None, profile = False,
+               log_level = 'DEBUG', memo_size = 0):
     self.config = config
     self.outdir = outdir
     self.expand_only = expand_only
     self.match_title = re.compile(match_title) if match_title else None
     self.max_pages = max_pages
+    self.page_timeout = page_timeout
+    self.profile = profile
 
     for name in ('dict', 'expanded'):
       path = '%s/%s' % (outdir, name)
@@ -431,7 +436,8 @@ class WiktionaryExtractor:
 
     self.munge = WikiMunge(
       config['lang_code'], outdir, template_filter = tfilt, log = log,
-      threads = threads)
+      threads = threads, compress = compress, backend = backend,
+      profile = profile, log_level = log_level, memo_size = memo_size)
 
 
   def load_titles(self):
@@ -466,11 +472,19 @@ class WiktionaryExtractor:
       json.dump(data, f, **json_args)
 
 
+  def expanded_path(self, title):
+    filename = title.replace(' ', '_').replace('/', '_')
+    return self.outdir + '/expanded/%s.txt' % filename
+
+
+  def dict_path(self, title):
+    return self.outdir + '/dict/%s.json' % title_to_filename(title)
+
+
   def extract_page(self, title, text):
     if self.match_title and not self.match_title.match(title): return
 
-    filename = title.replace(' ', '_').replace('/', '_')
-    exp_path = self.outdir + '/expanded/%s.txt' % filename
+    exp_path = self.expanded_path(title)
 
     if os.path.exists(exp_path) and not self.expand_only:
       with open(exp_path, 'r') as f: text = f.read()
@@ -487,37 +501,68 @@ class WiktionaryExtractor:
     if data: return title, data
 
 
+  def page_filter(self, model, ns, title):
+    return model == 'redirect' or not (ns == 'Talk' or ns.endswith(' talk'))
+
+
   def page_handler(self, model, ns, title, text):
     if model == 'redirect' or (
         ns and ns != 'Talk' and not ns.endswith(' talk')):
       self.munge.add_page(model, title, ''.join(text))
 
     elif model == 'wikitext':
-      tag = '==%s==' % self.config['lang']
-      text = ''.join(text)
-      i = text.find(tag)
-
-      if i != -1 and (i == 0 or text[i - 1] in '\r\n'):
-        text = text[i:]
-        i = 0
-
-        while i != -1:
-          i = text.find('==', i + 1)
-          if i != -1 and text[i - 1] in '\r\n' and text[i + 2] != '=':
-            text = text[0 : i]
-            i = -1
+      text = find_section(''.join(text), self.config['lang'])
 
+      if text is not None:
         self.titles.append(title)
         self.munge.add_page(model, title, text)
 
 
-  def run(self, path):
+  def update(self, path, index):
+    '''Updates the page cache from a newer dump, removes output for
+    changed pages and returns the titles which must be extracted again.'''
+    changed, deleted = self.munge.update(
+      path, self.page_handler, index, self.page_filter)
+
+    pages = self.munge.cache.pages
+    self.titles = [title for title in dict.fromkeys(self.titles)
+                   if title in pages]
+    self.save_titles()
+
+    # Dictionary files are shared by titles with the same file name
+    stale = set()
+
+    for title in changed | deleted:
+      for path in (self.expanded_path(title), self.dict_path(title)):
+        if os.path.exists(path): os.remove(path)
+
+      stale.add(self.dict_path(title))
+
+    return [title for title in self.titles if self.dict_path(title) in stale]
+
+
+  def run(self, path, index = None, sharded = False, update = False):
     global all_words
 
+    titles = None
+
     # Load pages
-    if not self.munge.cache.offset:
-      self.titles = []
-      self.munge.process(path, self.page_handler)
+    if self.munge.cache.complete:
+      if update: titles = self.update(path, index)
+
+    else:
+      if sharded:
+        self.titles = []
+        states = self.munge.process_parallel(
+          path, self.page_handler, index, self.page_filter,
+          state = lambda: self.titles)
+        self.titles = [title for shard in states for title in shard]
+
+      else:
+        self.titles = self.munge.resume_state() or []
+        self.munge.process(path, self.page_handler, index, self.page_filter,
+                           state = lambda: self.titles)
+
       self.save_titles()
 
     # Disable known bad templates
@@ -529,20 +574,46 @@ class WiktionaryExtractor:
     all_words = set(self.titles)
 
     # Extract entries
-    titles = self.titles[0 : self.max_pages]
-    results = self.munge.reprocess(titles, self.extract_page)
+    if titles is None: titles = self.titles
+    titles = titles[0 : self.max_pages]
+    results = self.munge.reprocess(titles, self.extract_page,
+                                   self.page_timeout)
 
     # Save extracted data
     for title, data in results:
-      filename = title_to_filename(title)
-      path = self.outdir + '/dict/%s.json' % filename
-      self.save_dict_entry(path, data)
+      self.save_dict_entry(self.dict_path(title), data)
+
+    # Save the pages which failed
+    with open(self.outdir + '/failures.txt', 'w') as f:
+      for title, stage, msg in self.munge.failures:
+        f.write('%s\t%s\t%s\n' % (title, stage, msg.split('\n')[0]))
+
+    if self.profile: self.munge.profile_report(self.outdir + '/profile.txt')
+
+    memo = self.munge.ctx.template_memo
+    if memo:
+      print('Template memo: {hits:,} hits {misses:,} misses ({hit_rate:.1%}) '
+            '{impure:,} impure {evictions:,} evictions'.format(**memo.stats()))
 
 
 parser = argparse.ArgumentParser(
   prog = 'wiktionary-extract',
   description = 'Extract language data from wiktionary dump files.')
-parser.add_argument('filename', help = 'Wiktionary XML input file')
+parser.add_argument('filename',
+                    help = 'Wiktionary XML input file or - for stdin')
+parser.add_argument('-i', '--index',
+                    help = 'Multistream index file for parallel loading.')
+parser.add_argument('-s', '--sharded', action = 'store_true',
+                    help = 'Load an uncompressed or multistream dump with '
+                    'parallel workers.')
+parser.add_argument('-u', '--update', action = 'store_true',
+                    help = 'Update a loaded cache from a newer dump and only '
+                    'extract changed entries.')
+parser.add_argument('-z', '--compress', choices = ('zlib', 'lzma'),
+                    help = 'Store a newly loaded page cache in compressed '
+                    'blocks.')
+parser.add_argument('-b', '--backend', choices = ('file', 'sqlite'),
+                    default = 'file', help = 'Page cache storage backend.')
 parser.add_argument('-l', '--lang', help = 'Input file language',
                     required = True, choices = configs.keys())
 parser.add_argument('--expand-only', help = 'Only expand entries',
@@ -553,6 +624,18 @@ parser.add_argument('--threads', type = int,
                     help = 'Number of processor threads to use.')
 parser.add_argument('-n', '--max-pages', type = int,
                     help = 'Maximum number of pages to expand.')
+parser.add_argument('-t', '--page-timeout', type = float, metavar = 'SECS',
+                    help = 'Give up on a page after this many seconds.')
+parser.add_argument('-p', '--profile', action = 'store_true',
+                    help = 'Write the time spent in each template and parser '
+                    'function to profile.txt.')
+
+parser.add_argument('--log-level', choices = ('DEBUG', 'WARNING', 'ERROR'),
+                    default = 'DEBUG',
+                    help = 'Leave out less severe messages from the log.')
+parser.add_argument('--memo-size', type = int, default = 0, metavar = 'CHARS',
+                    help = 'Memoize template expansions up to this many '
+                    'characters in each thread.')
 
 args = parser.parse_args()
 config = configs[args.lang]
@@ -563,6 +646,9 @@ log = outdir + '/log.txt'
 we = WiktionaryExtractor(
   config, outdir, threads = args.threads, log = log,
   match_title = args.match, expand_only = args.expand_only,
-  max_pages = args.max_pages)
+  max_pages = args.max_pages, compress = args.compress,
+  backend = args.backend, page_timeout = args.page_timeout,
+  profile = args.profile, log_level = args.log_level,
+  memo_size = args.memo_size)
 
-we.run(args.filename)
+we.run(args.filename, args.index, args.sharded, args.update)